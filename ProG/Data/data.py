@@ -7,6 +7,7 @@ from torch_geometric.data import Batch
 from collections import defaultdict
 from torch_geometric.datasets import TUDataset
 from torch_geometric.transforms import NormalizeFeatures
+from ProG.utils import check_normalized_adj
 def multi_class_NIG(dataname, num_class,shots=100):
     """
     NIG: node induced graphs
@@ -33,6 +34,8 @@ def multi_class_NIG(dataname, num_class,shots=100):
                 train_list.append(g)
 
     shuffle(train_list)
+    # the GCN adjacency stored by data_preprocess is kept only if it still matches its graph
+    check_normalized_adj(train_list, 'GCN')
     train_data = Batch.from_data_list(train_list)
 
     test_list = []
@@ -52,6 +55,8 @@ def multi_class_NIG(dataname, num_class,shots=100):
                 test_list.append(g)
 
     shuffle(test_list)
+    # the GCN adjacency stored by data_preprocess is kept only if it still matches its graph
+    check_normalized_adj(test_list, 'GCN')
     test_data = Batch.from_data_list(test_list)
 
     for key, value in statistic.items():
@@ -8,7 +8,7 @@ from torch_geometric.datasets import Planetoid, Amazon
 from torch_geometric.data import Data, Batch
 import random
 import warnings
-from ProG.utils import mkdir
+from ProG.utils import mkdir, attach_normalized_adj
 from random import shuffle
 
 # this file has been tested applicable on PubMed and CiteSeer.
@@ -174,6 +174,8 @@ def induced_graphs_nodes(data, dataname: str = None, num_classes=3, smallest_siz
 
             x = ori_x[subset]
             induced_graph = Data(x=x, edge_index=sub_edge_index, y=label)
+            # the normalized adjacency is computed once here and stored with the graph
+            induced_graph = attach_normalized_adj(induced_graph, 'GCN')
             induced_graph_list.append(induced_graph)
             print('graph size {} at {:.2f}%...'.format(induced_graph.x.shape[0], iteration * 100.0 / value.shape[0]))
 
@@ -262,6 +264,8 @@ def induced_graphs_edges(data, dataname: str = None, num_classes=3, smallest_siz
             sub_edge_index, _ = subgraph(subset, edge_index, relabel_nodes=True)
 
             induced_graph = Data(x=x, edge_index=sub_edge_index, y=label)
+            # the normalized adjacency is computed once here and stored with the graph
+            induced_graph = attach_normalized_adj(induced_graph, 'GCN')
 
             # if not(smallest_size <= induced_graph.x.shape[0] <= largest_size):
             #     print(induced_graph.x.shape[0])
@@ -360,7 +364,7 @@ def induced_graphs_graphs(data, dataname: str = None, num_classes=3, smallest_si
                 sub_edge_index, _ = subgraph(subset, same_label_edge_index, num_nodes=num_nodes, relabel_nodes=True)
 
                 x = ori_x[subset]
-                graph = Data(x=x, edge_index=sub_edge_index)
+                graph = attach_normalized_adj(Data(x=x, edge_index=sub_edge_index), 'GCN')
                 induced_graph_dic_list['pos'].append(graph)
 
             pk.dump(induced_graph_dic_list,
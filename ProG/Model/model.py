@@ -12,10 +12,14 @@ from torch_geometric.nn import GraphConv as GConv
 import numpy as np
 import sklearn.linear_model as lm
 import sklearn.metrics as skm
-from sklearn.cluster import KMeans
 
-from ..utils import act
+from ..utils import act, center_heads, TorchKMeans, activation_memory, adj_matches_conv, fp32_region
+from ..registry import load_checkpoint, load_into
+from torch.utils.checkpoint import checkpoint as checkpoint_fn
 from torch_geometric.nn import MessagePassing
+from torch_geometric.nn.conv.gcn_conv import gcn_norm
+from torch_geometric.utils import scatter
+import os
 
     
 class SAGE(nn.Module):
@@ -67,8 +71,15 @@ class SAGE(nn.Module):
         return self.prediction(z_i), pos_neg_labels
 
     
+@fp32_region
+def spmm(adj, h):
+    # torch.sparse.mm has no autocast rule, under mixed_precision the bf16 features are cast to the fp32 adjacency
+    return torch.sparse.mm(adj, h)
+
+
 class GNN(torch.nn.Module):
-    def __init__(self, input_dim, hid_dim=None, out_dim=None, num_layer=3,JK="last", drop_ratio=0, pool='mean', gnn_type='GAT'):
+    def __init__(self, input_dim, hid_dim=None, out_dim=None, num_layer=3,JK="last", drop_ratio=0, pool='mean', gnn_type='GAT',
+                 checkpoint=False):
         super().__init__()
         """
         Args:
@@ -77,6 +88,8 @@ class GNN(torch.nn.Module):
             drop_ratio (float): dropout rate
             JK (str): last, concat, max or sum.
             pool (str): sum, mean, max, attention, set2set
+            checkpoint (bool or list of int): activation checkpointing for all layers (True) or for the layers at
+                the given indices. their activations are recomputed in backward instead of being kept.
             
         See https://arxiv.org/abs/1810.00826
         JK-net: https://arxiv.org/abs/1806.03536
@@ -128,20 +141,48 @@ class GNN(torch.nn.Module):
             raise ValueError("Invalid graph pooling type.")
 
         self.gnn_type = gnn_type
+        if checkpoint is True:
+            checkpoint = range(num_layer)
+        self.checkpoint_layers = set(checkpoint or [])
 
-    def forward(self, x, edge_index, batch = None, prompt = None):
-        h_list = [x]
-        for idx, conv in enumerate(self.conv_layers[0:-1]):
-            if idx == 0 and prompt is not None:
-                x = prompt.add(x)
+    def layer_forward(self, idx, x, edge_index, adj=None):
+        conv = self.conv_layers[idx]
+        # a conv with non default normalization or aggregation does not match the cached adjacency
+        if adj is None or not adj_matches_conv(conv, self.gnn_type):
             x = conv(x, edge_index)
+        elif self.gnn_type == 'GCN':
+            x = spmm(adj, conv.lin(x))
+            if conv.bias is not None:
+                x = x + conv.bias
+        elif self.gnn_type == 'GraphSage':
+            out = conv.lin_l(spmm(adj, x))
+            if conv.root_weight:
+                out = out + conv.lin_r(x)
+            x = F.normalize(out, p=2., dim=-1) if conv.normalize else out
+        if idx != len(self.conv_layers) - 1:
             x = act(x)
             x = F.dropout(x, self.drop_ratio, training=self.training)
-            h_list.append(x)
-        x = self.conv_layers[-1](x, edge_index)
-        h_list.append(x)
+        return x
+
+    def forward(self, x, edge_index, batch = None, prompt = None, adj = None):
+        """
+        :param adj: optional cached normalized adjacency (utils.csr_adj), message passing is then one SpMM per
+                    layer and edge_index is not used. only for GCN and mean GraphSage, layers whose settings differ
+                    from utils.normalized_adj still use edge_index.
+        """
+        # with JK last only the output of the last layer is needed, so the intermediates are not kept
+        h_list = [x] if self.JK != "last" else None
+        for idx in range(len(self.conv_layers)):
+            if idx == 0 and prompt is not None:
+                x = prompt.add(x)
+            if idx in self.checkpoint_layers and self.training and torch.is_grad_enabled():
+                x = checkpoint_fn(self.layer_forward, idx, x, edge_index, adj, use_reentrant=False)
+            else:
+                x = self.layer_forward(idx, x, edge_index, adj)
+            if h_list is not None:
+                h_list.append(x)
         if self.JK == "last":
-            node_emb = h_list[-1]
+            node_emb = x
         elif self.JK == "sum":
             h_list = [h.unsqueeze_(0) for h in h_list]
             node_emb = torch.sum(torch.cat(h_list[1:], dim=0), dim=0)[0]
@@ -152,15 +193,224 @@ class GNN(torch.nn.Module):
             graph_emb = self.pool(node_emb, batch.long())
             return graph_emb
 
+    def memory_report(self, x, edge_index, batch=None):
+        """
+        activation memory of one training step of this GNN without checkpointing and with the configured
+        checkpointing (all layers if none is configured). gradients of the steps are discarded.
+        """
+        layers, was_training = self.checkpoint_layers, self.training
+        self.train()
+        report = {}
+        for name, ckpt in [('no_checkpoint', set()), ('checkpoint', layers or set(range(len(self.conv_layers))))]:
+            self.checkpoint_layers = ckpt
+            report[name] = activation_memory(lambda: self(x, edge_index, batch), exclude=list(self.parameters()))
+            self.zero_grad(set_to_none=True)
+            print("{} | saved activations: {:.2f} MB | peak cuda: {:.2f} MB".format(
+                name, report[name]['saved_mb'], report[name]['peak_cuda_mb']))
+        self.checkpoint_layers = layers
+        self.train(was_training)
+        return report
+
+    @torch.no_grad()
+    def inference(self, x, edge_index, batch=None, prompt=None, chunk_size=65536, spill_dir=None, device=None):
+        """
+        layer-wise forward for graphs that do not fit in memory as a whole. one layer is computed at a time,
+        chunk_size target nodes at once, gathering only the in-neighbors of the chunk. only the input and the
+        output of the current layer are kept, both of them can live on disk.
+        it gives the same embeddings as forward in eval mode (JK last only).
+
+        :param x: node features, a cpu tensor or a numpy array / memmap
+        :param edge_index: edges of the whole graph, on cpu
+        :param spill_dir: if given, the output of every layer is written to a np.memmap 'layer<i>.npy' in this
+                          folder instead of RAM
+        :param device: device the chunks are computed on, default the device of the weights
+        :return: node embeddings (batch is None) or graph embeddings, on cpu
+        """
+        if self.JK != 'last':
+            raise ValueError('GNN.inference only supports JK="last" but you set {}'.format(self.JK))
+        device = next(self.parameters()).device if device is None else device
+        num_nodes = x.shape[0]
+        edge_index = edge_index.cpu()
+
+        # GCNConv is not bipartite: normalize once for the whole graph, then every layer is lin(sum w * x_j) + bias
+        edge_weight = None
+        if self.gnn_type == 'GCN':
+            conv = self.conv_layers[0]
+            if conv.normalize:
+                edge_index, edge_weight = gcn_norm(edge_index, None, num_nodes, conv.improved, conv.add_self_loops)
+            else:
+                edge_weight = torch.ones(edge_index.shape[1])
+
+        # csr order: the in-edges of the nodes [i, j) are edge_index[:, ptr[i]:ptr[j]]
+        order = torch.sort(edge_index[1], stable=True)[1]
+        edge_index = edge_index[:, order]
+        if edge_weight is not None:
+            edge_weight = edge_weight[order]
+        ptr = torch.cat([torch.zeros(1, dtype=torch.long),
+                         torch.cumsum(torch.bincount(edge_index[1], minlength=num_nodes), 0)])
+
+        for idx, conv in enumerate(self.conv_layers):
+            out = None
+            for start in range(0, num_nodes, chunk_size):
+                end = min(start + chunk_size, num_nodes)
+                e_start, e_end = ptr[start].item(), ptr[end].item()
+                row, col = edge_index[0, e_start:e_end], edge_index[1, e_start:e_end] - start
+
+                # the targets come first in the sources, so that target i is source i too (self loops of GAT)
+                outside = (row < start) | (row >= end)
+                extra = torch.unique(row[outside])
+                src_nodes = torch.cat([torch.arange(start, end), extra])
+                local_row = row - start
+                local_row[outside] = torch.searchsorted(extra, row[outside]) + (end - start)
+
+                x_src = self.gather_rows(x, src_nodes).to(device)
+                if idx == 0 and prompt is not None:
+                    x_src = prompt.add(x_src)
+                local_row, col = local_row.to(device), col.to(device)
+                if edge_weight is not None:
+                    msg = edge_weight[e_start:e_end].to(device).view(-1, 1) * x_src[local_row]
+                    h = conv.lin(scatter(msg, col, dim=0, dim_size=end - start, reduce='sum'))
+                    if conv.bias is not None:
+                        h = h + conv.bias
+                else:
+                    h = conv((x_src, x_src[:end - start]), torch.stack([local_row, col]))
+                if idx != len(self.conv_layers) - 1:
+                    h = act(h)
+
+                h = h.cpu()
+                if out is None:
+                    out = self.layer_buffer(num_nodes, h.shape[1], h.dtype, spill_dir, idx)
+                out[start:end] = h.numpy() if isinstance(out, np.ndarray) else h
+            x = out
+
+        if isinstance(x, np.ndarray):
+            x.flush()
+            x = torch.from_numpy(x)
+        if batch is None:
+            return x
+
+        batch = batch.cpu().long()
+        num_graphs = int(batch.max()) + 1
+        is_max = self.pool is global_max_pool
+        graph_emb = torch.full((num_graphs, x.shape[1]), float('-inf') if is_max else 0., dtype=x.dtype)
+        for start in range(0, num_nodes, chunk_size):
+            h, b = x[start:start + chunk_size], batch[start:start + chunk_size]
+            graph_emb.scatter_reduce_(0, b.view(-1, 1).expand_as(h), h, reduce='amax' if is_max else 'sum')
+        if self.pool is global_mean_pool:
+            graph_emb = graph_emb / torch.bincount(batch, minlength=num_graphs).clamp(min=1).view(-1, 1)
+        return graph_emb
+
+    @staticmethod
+    def gather_rows(x, index):
+        if isinstance(x, np.ndarray):
+            return torch.from_numpy(np.ascontiguousarray(x[index.numpy()]))
+        return x[index]
+
+    @staticmethod
+    def layer_buffer(num_rows, dim, dtype, spill_dir, layer):
+        if spill_dir is None:
+            return torch.empty(num_rows, dim, dtype=dtype)
+        os.makedirs(spill_dir, exist_ok=True)
+        path = os.path.join(spill_dir, 'layer{}.npy'.format(layer))
+        return np.lib.format.open_memmap(path, mode='w+', dtype=torch.empty(0, dtype=dtype).numpy().dtype,
+                                         shape=(num_rows, dim))
+
     def decode(self, z, edge_label_index):
         return (z[edge_label_index[0]] * z[edge_label_index[1]]).sum(dim=-1)
 
     def decode_all(self, z):
-        prob_adj = z @ z.t()
-        return (prob_adj > 0).nonzero(as_tuple=False).t()
+        return self.decode_topk(z)
+
+    @torch.no_grad()
+    def decode_topk(self, z, k=None, threshold=0., max_edges=None, exclude_edge_index=None, block_size=4096,
+                    out_path=None, exclude_self=None):
+        """
+        links (i, j) with z_i * z_j > threshold, computed block_size rows at a time instead of the dense z @ z.t().
+        with the defaults it returns the same edges as the former dense decode_all.
+
+        :param k: keep at most the k best links per node
+        :param max_edges: keep at most the max_edges best links overall
+        :param exclude_edge_index: known links (e.g. training edges) that are never returned
+        :param exclude_self: never return self loops (i, i). None: only when k or exclude_edge_index is given, since
+                             z_i * z_i > 0 would otherwise take one of the k slots of every node
+        :param out_path: if given, the links are appended block by block to this file as raw int64 (i, j) pairs
+                         (read back with np.fromfile(out_path, dtype=np.int64).reshape(-1, 2)), and the number
+                         of links is returned. with max_edges the file is written once at the end.
+        :return: edge_index of the links, ordered by i then j
+        """
+        num_nodes = z.shape[0]
+        if exclude_self is None:
+            exclude_self = k is not None or exclude_edge_index is not None
+        if exclude_edge_index is not None:
+            ex_row, ex_col = exclude_edge_index.to(z.device)
+            order = torch.sort(ex_row, stable=True)[1]
+            ex_row, ex_col = ex_row[order], ex_col[order]
+            ex_ptr = torch.cat([ex_row.new_zeros(1), torch.cumsum(torch.bincount(ex_row, minlength=num_nodes), 0)])
+
+        out_file = open(out_path, 'wb') if out_path is not None and max_edges is None else None
+        rows, cols, vals = [], [], []
+        num_links = 0
+        for start in range(0, num_nodes, block_size):
+            end = min(start + block_size, num_nodes)
+            score = torch.mm(z[start:end], z.t())
+            if exclude_edge_index is not None:
+                e_start, e_end = ex_ptr[start].item(), ex_ptr[end].item()
+                score[ex_row[e_start:e_end] - start, ex_col[e_start:e_end]] = float('-inf')
+            if exclude_self:
+                diag = torch.arange(end - start, device=z.device)
+                score[diag, diag + start] = float('-inf')
+
+            if k is not None:
+                val, col = score.topk(min(k, num_nodes), dim=1)
+                row = torch.arange(start, end, device=z.device).view(-1, 1).expand_as(col)
+                keep = val > threshold
+                row, col, val = row[keep], col[keep], val[keep]
+                order = torch.sort(row * num_nodes + col)[1]
+                row, col, val = row[order], col[order], val[order]
+            else:
+                row, col = (score > threshold).nonzero(as_tuple=True)
+                val = score[row, col]
+                row = row + start
+
+            if max_edges is not None:
+                rows.append(row), cols.append(col), vals.append(val)
+                row, col, val = torch.cat(rows), torch.cat(cols), torch.cat(vals)
+                if val.numel() > max_edges:
+                    best = val.topk(max_edges)[1]
+                    row, col, val = row[best], col[best], val[best]
+                rows, cols, vals = [row], [col], [val]
+            elif out_file is not None:
+                torch.stack([row, col], dim=1).cpu().numpy().astype(np.int64).tofile(out_file)
+                num_links += row.numel()
+            else:
+                rows.append(row), cols.append(col)
+
+        if out_file is not None:
+            out_file.close()
+            return num_links
+
+        if len(rows) == 0:
+            edge_index = torch.empty(2, 0, dtype=torch.long, device=z.device)
+        else:
+            row, col = torch.cat(rows), torch.cat(cols)
+            if max_edges is not None:
+                order = torch.sort(row * num_nodes + col)[1]
+                row, col = row[order], col[order]
+            edge_index = torch.stack([row, col])
+
+        if out_path is not None:
+            edge_index.t().cpu().numpy().astype(np.int64).tofile(out_path)
+            return edge_index.shape[1]
+        return edge_index
 
 class GPPT(nn.Module):
-    def __init__(self, in_feats, n_hidden=128, n_classes=None, n_layers=2, activation = F.relu, dropout=0.5, center_num=3):
+    def __init__(self, in_feats, n_hidden=128, n_classes=None, n_layers=2, activation = F.relu, dropout=0.5, center_num=3,
+                 prompt_update_every=1, kmeans_batch_size=None):
+        """
+        :param prompt_update_every: the prompt centers are re-clustered every prompt_update_every calls of
+                                    update_prompt_weight, warm-started from the current centers
+        :param kmeans_batch_size: hidden states sampled per mini-batch k-means step, None means all of them
+        """
         super(GPPT, self).__init__()
         self.layers = nn.ModuleList()
         self.dropout = nn.Dropout(dropout)
@@ -174,29 +424,38 @@ class GPPT(nn.Module):
             self.layers.append(SAGEConv(n_hidden, n_hidden))
 
         self.prompt=nn.Linear(n_hidden,self.center_num,bias=False)
-        
-        self.pp = nn.ModuleList()
-        for i in range(self.center_num):
-            self.pp.append(nn.Linear(2*n_hidden,n_classes,bias=False))
-        
-        
+
+        # one [n_classes, n_hidden] head per center, stacked so that all heads are applied in one matmul
+        self.pp_weight = nn.Parameter(torch.empty(self.center_num, n_classes, n_hidden))
+        for w in self.pp_weight.data:
+            nn.init.kaiming_uniform_(w, a=5 ** 0.5)
+
+        # every replica updates its prompt at the same steps, the centers are synchronized over the workers
+        self.kmeans = TorchKMeans(self.center_num, n_init=10, batch_size=kmeans_batch_size, seed=0, distributed=True)
+        self.prompt_update_every = prompt_update_every
+        self.prompt_step = 0
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        # checkpoints saved before the heads were stacked hold one 'pp.i.weight' entry per center
+        old_keys = ['{}pp.{}.weight'.format(prefix, i) for i in range(self.center_num)]
+        if all(k in state_dict for k in old_keys):
+            state_dict[prefix + 'pp_weight'] = torch.stack([state_dict.pop(k) for k in old_keys])
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                      missing_keys, unexpected_keys, error_msgs)
+
+    def checkpoint_path(self, args):
+        return './data_smc/'+args.dataset+'_model_'+args.file_id+'.pt'
+
     def model_to_array(self,args):
-        s_dict = torch.load('./data_smc/'+args.dataset+'_model_'+args.file_id+'.pt')#,map_location='cuda:0')
-        keys = list(s_dict.keys())
-        res = s_dict[keys[0]].view(-1)
-        for i in np.arange(1, len(keys), 1):
-            res = torch.cat((res, s_dict[keys[i]].view(-1)))
-        return res
+        # every tensor of the checkpoint flattened into one
+        return torch.cat([t.reshape(-1) for t in load_checkpoint(self.checkpoint_path(args)).values()])
+
     def array_to_model(self, args):
-        arr=self.model_to_array(args)
-        m_m=torch.load('./data_smc/'+args.dataset+'_model_'+args.file_id+'.pt')#,map_location='cuda:0')#+str(args.gpu))
-        indice = 0
+        # the checkpoint is loaded once, memory-mapped, and its tensors are used as they are
         s_dict = self.state_dict()
-        for name, param in m_m.items():
-            length = torch.prod(torch.tensor(param.shape))
-            s_dict[name] = arr[indice:indice + length].view(param.shape)
-            indice = indice + length
-        self.load_state_dict(s_dict)
+        s_dict.update(load_checkpoint(self.checkpoint_path(args)))
+        load_into(self, s_dict)
     
     def load_parameters(self, args):
         self.args=args
@@ -213,9 +472,7 @@ class GPPT(nn.Module):
         
         features=h[index]
         labels=label[index.long()]
-        cluster = KMeans(n_clusters=self.center_num, n_init=10, random_state=0).fit(features.detach().cpu())
-        
-        temp=torch.FloatTensor(cluster.cluster_centers_).cuda()
+        temp=self.kmeans.fit(features)
         self.prompt.weight.data = temp.clone().detach()
         
 
@@ -223,21 +480,20 @@ class GPPT(nn.Module):
         for i in range(self.n_classes):
             p.append(features[labels==i].mean(dim=0).view(1,-1))
         temp=torch.cat(p,dim=0)
-        for i in range(self.center_num):
-            self.pp[i].weight.data = temp.clone().detach()
+        self.pp_weight.data.copy_(temp.detach().expand_as(self.pp_weight))
         
     
     def update_prompt_weight(self,h):
-        cluster = KMeans(n_clusters=self.center_num, n_init=10, random_state=0).fit(h.detach().cpu())
-        temp=torch.FloatTensor(cluster.cluster_centers_).cuda()
+        self.prompt_step += 1
+        if self.prompt_step % self.prompt_update_every != 0:
+            return
+        # hidden states may come from a mixed precision forward, the centers stay fp32
+        temp=self.kmeans.partial_fit(h.float(), init=self.prompt.weight)
         self.prompt.weight.data = temp.clone().detach()
 
     def get_mul_prompt(self):
-        pros=[]
-        for name,param in self.named_parameters():
-            if name.startswith('pp.'):
-                pros.append(param)
-        return pros
+        # one [n_classes, n_hidden] view per center head
+        return list(self.pp_weight.unbind(0))
         
     def get_prompt(self):
         for name,param in self.named_parameters():
@@ -261,7 +517,5 @@ class GPPT(nn.Module):
         h = x
         out=self.prompt(h)
         index=torch.argmax(out, dim=1)
-        out=torch.FloatTensor(h.shape[0],self.n_classes).cuda()
-        for i in range(self.center_num):
-            out[index==i]=self.pp[i](h[index==i])
-        return out
\ No newline at end of file
+        return center_heads(h, self.pp_weight, index)
+
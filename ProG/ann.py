@@ -0,0 +1,95 @@
+import torch
+
+from .utils import TorchKMeans
+from .prompt import sparse_links
+
+
+class TokenIVFIndex:
+    def __init__(self, n_lists=16, n_probe=4, rebuild_every=50, kmeans_iter=1, chunk_size=4096, seed=0):
+        """
+        inverted-file index over prompt tokens for HeavyPrompt cross links.
+        tokens are clustered into n_lists lists; a node is only compared with the tokens of the n_probe lists whose
+        centroids have the largest inner product with it, so only the token-node pairs likely to pass cross_prune
+        are scored.
+
+        :param rebuild_every: the lists follow the tokens with warm-started mini-batch k-means steps after every
+                              token update, and are re-clustered from scratch every rebuild_every updates
+        :param kmeans_iter: mini-batch k-means steps per token update
+        :param chunk_size: nodes scored at once against one list
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.rebuild_every = rebuild_every
+        self.chunk_size = chunk_size
+        self.kmeans = TorchKMeans(n_lists, n_init=1, n_iter=kmeans_iter, seed=seed)
+
+        self.lists = None
+        self._key = None
+        self._updates = 0
+
+    def update(self, tokens):
+        """
+        follows the tokens after they moved. nothing is done if they did not change since the last call.
+        """
+        key = (tokens.data_ptr(), tokens._version, tuple(tokens.shape))
+        if key == self._key:
+            return
+
+        t = tokens.detach()
+        n_lists = min(self.n_lists, t.shape[0])
+        if self._key is None or self._key[2] != key[2] or self._updates >= self.rebuild_every:
+            self.kmeans.n_clusters = n_lists
+            self.kmeans.fit(t)
+            self._updates = 0
+        else:
+            self.kmeans.partial_fit(t)
+            self._updates += 1
+
+        labels = torch.cdist(t, self.kmeans.centers).argmin(dim=1)
+        order = torch.sort(labels, stable=True)[1]
+        counts = torch.bincount(labels, minlength=n_lists).tolist()
+        self.lists = list(torch.split(order, counts))
+        self._key = key
+
+    def search(self, tokens, x, prune):
+        """
+        :return: (token index, node index, similarity) of the probed pairs with sigmoid(token*node) >= prune,
+                 ordered by token then node.
+        """
+        self.update(tokens)
+        with torch.no_grad():
+            n_probe = min(self.n_probe, len(self.lists))
+            probe = torch.mm(x, self.kmeans.centers.t()).topk(n_probe, dim=1)[1]
+
+            rows, cols, vals = [], [], []
+            for l, members in enumerate(self.lists):
+                if members.numel() == 0:
+                    continue
+                nodes = (probe == l).any(dim=1).nonzero().view(-1)
+                for start in range(0, nodes.numel(), self.chunk_size):
+                    n = nodes[start:start + self.chunk_size]
+                    sim = torch.sigmoid(torch.mm(tokens[members], x[n].t()))
+                    adj = torch.where(sim < prune, 0, sim)
+                    r, c = adj.nonzero().t()
+                    rows.append(members[r])
+                    cols.append(n[c])
+                    vals.append(sim[r, c])
+
+            if len(rows) == 0:
+                empty = torch.empty(0, dtype=torch.long, device=x.device)
+                return empty, empty, torch.empty(0, dtype=x.dtype, device=x.device)
+            row, col, val = torch.cat(rows), torch.cat(cols), torch.cat(vals)
+            order = torch.sort(row * x.shape[0] + col)[1]
+            return row[order], col[order], val[order]
+
+    def recall(self, tokens, x, prune):
+        """
+        share of the exact cross links (same threshold, no top-k or budget) that the index finds.
+        """
+        exact_row, exact_col = sparse_links(tokens, x, prune, chunk_size=self.chunk_size)
+        row, col, _ = self.search(tokens, x, prune)
+
+        exact = exact_row * x.shape[0] + exact_col
+        found = torch.isin(exact, row * x.shape[0] + col).sum().item()
+        recall = found / exact.numel() if exact.numel() > 0 else 1.0
+        return {'recall': recall, 'exact_links': exact.numel(), 'ann_links': row.numel()}
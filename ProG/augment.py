@@ -0,0 +1,273 @@
+import copy
+import time
+
+import numpy as np
+import torch
+from torch_geometric.data import Batch
+
+
+def randperm(n, device, generator=None):
+    """
+    random permutation of n drawn on the device of generator (which may differ from the data), moved to device
+    """
+    gen_device = generator.device if generator is not None else device
+    return torch.randperm(n, generator=generator, device=gen_device).to(device)
+
+
+def rand(n, device, generator=None, dtype=torch.float32):
+    gen_device = generator.device if generator is not None else device
+    return torch.rand(n, generator=generator, device=gen_device, dtype=dtype).to(device)
+
+
+def coin(generator=None):
+    gen_device = generator.device if generator is not None else 'cpu'
+    return torch.randint(2, (1,), generator=generator, device=gen_device).item() == 0
+
+
+def drop_nodes(data, aug_ratio, generator=None):
+    """
+    drops int(num_nodes * aug_ratio) random nodes together with their edges, the kept nodes are relabeled in their
+    original order. only x and edge_index are updated.
+    :return: a shallow copy of data, data itself is not changed
+    """
+    x, edge_index = data.x, data.edge_index
+    node_num = x.shape[0]
+    drop_num = int(node_num * aug_ratio)
+
+    keep = torch.ones(node_num, dtype=torch.bool, device=x.device)
+    keep[randperm(node_num, x.device, generator)[:drop_num]] = False
+    relabel = torch.cumsum(keep, dim=0) - 1
+
+    out = copy.copy(data)
+    out.x = x[keep]
+    out.edge_index = relabel[edge_index[:, keep[edge_index[0]] & keep[edge_index[1]]]]
+    return out
+
+
+def permute_edges(data, aug_ratio, generator=None):
+    """
+    drops int(num_edges * aug_ratio) random edges, the kept ones stay in their original order.
+    :return: a shallow copy of data, data itself is not changed
+    """
+    edge_index = data.edge_index
+    edge_num = edge_index.shape[1]
+    permute_num = int(edge_num * aug_ratio)
+
+    keep = randperm(edge_num, edge_index.device, generator)[:edge_num - permute_num]
+    out = copy.copy(data)
+    out.edge_index = edge_index[:, torch.sort(keep)[0]]
+    return out
+
+
+def mask_nodes(data, aug_ratio, generator=None):
+    """
+    replaces the features of int(num_nodes * aug_ratio) random nodes by the mean feature of the graph.
+    x is not written in place: the view gets a new tensor and the source graph is left untouched.
+    :return: a shallow copy of data
+    """
+    x = data.x
+    node_num = x.shape[0]
+    mask_num = int(node_num * aug_ratio)
+
+    mask = torch.zeros(node_num, dtype=torch.bool, device=x.device)
+    mask[randperm(node_num, x.device, generator)[:mask_num]] = True
+    out = copy.copy(data)
+    out.x = torch.where(mask.view(-1, 1), x.mean(dim=0, keepdim=True), x)
+    return out
+
+
+def graph_views(data, aug='random', aug_ratio=0.1, generator=None):
+    if aug == 'dropN':
+        return drop_nodes(data, aug_ratio, generator)
+    elif aug == 'permE':
+        return permute_edges(data, aug_ratio, generator)
+    elif aug == 'maskN':
+        return mask_nodes(data, aug_ratio, generator)
+    elif aug == 'random':
+        if coin(generator):
+            return drop_nodes(data, aug_ratio, generator)
+        return permute_edges(data, aug_ratio, generator)
+    raise ValueError("aug should be dropN, permE, maskN or random but got {}".format(aug))
+
+
+def batch_ratios(aug_ratio, num_graphs, device, generator=None):
+    """
+    per-graph ratios from a float, a [num_graphs] tensor or a (low, high) range sampled uniformly per graph
+    """
+    if isinstance(aug_ratio, (tuple, list)):
+        low, high = aug_ratio
+        return low + (high - low) * rand(num_graphs, device, generator)
+    if torch.is_tensor(aug_ratio):
+        return aug_ratio.to(device)
+    return torch.full((num_graphs,), float(aug_ratio), device=device)
+
+
+def group_rank(group, num_groups, generator=None):
+    """
+    random rank of every element inside its group, e.g. of every node inside its graph
+    """
+    key = rand(group.shape[0], group.device, generator, dtype=torch.float64)
+    order = torch.sort(group.to(torch.float64) + key)[1]
+    counts = torch.bincount(group, minlength=num_groups)
+    start = torch.cumsum(counts, dim=0) - counts
+    rank = torch.empty_like(group)
+    rank[order] = torch.arange(group.shape[0], device=group.device) - start[group[order]]
+    return rank, counts
+
+
+def batch_drop_nodes(batch, aug_ratio, generator=None):
+    """
+    drop_nodes for every graph of a collated Batch at once, graph i loses int(num_nodes_i * ratio_i) nodes.
+    :return: a new Batch with x, edge_index, batch and ptr
+    """
+    node_batch, edge_index = batch.batch, batch.edge_index
+    num_graphs = batch.num_graphs
+    ratio = batch_ratios(aug_ratio, num_graphs, node_batch.device, generator)
+
+    rank, counts = group_rank(node_batch, num_graphs, generator)
+    drop_num = (counts * ratio).long()
+    keep = rank >= drop_num[node_batch]
+    relabel = torch.cumsum(keep, dim=0) - 1
+    edge_index = relabel[edge_index[:, keep[edge_index[0]] & keep[edge_index[1]]]]
+
+    ptr = torch.cat([counts.new_zeros(1), torch.cumsum(counts - drop_num, dim=0)])
+    return Batch(x=batch.x[keep], edge_index=edge_index, batch=node_batch[keep], ptr=ptr)
+
+
+def batch_permute_edges(batch, aug_ratio, generator=None):
+    """
+    permute_edges for every graph of a collated Batch at once, graph i loses int(num_edges_i * ratio_i) edges.
+    """
+    node_batch, edge_index = batch.batch, batch.edge_index
+    num_graphs = batch.num_graphs
+    ratio = batch_ratios(aug_ratio, num_graphs, node_batch.device, generator)
+
+    edge_batch = node_batch[edge_index[0]]
+    rank, counts = group_rank(edge_batch, num_graphs, generator)
+    keep = rank >= (counts * ratio).long()[edge_batch]
+    return Batch(x=batch.x, edge_index=edge_index[:, keep], batch=node_batch, ptr=batch.ptr)
+
+
+def batch_mask_nodes(batch, aug_ratio, generator=None):
+    """
+    mask_nodes for every graph of a collated Batch at once, masked nodes get the mean feature of their own graph.
+    """
+    x, node_batch = batch.x, batch.batch
+    num_graphs = batch.num_graphs
+    ratio = batch_ratios(aug_ratio, num_graphs, node_batch.device, generator)
+
+    rank, counts = group_rank(node_batch, num_graphs, generator)
+    mask = rank < (counts * ratio).long()[node_batch]
+    mean = torch.zeros(num_graphs, x.shape[1], dtype=x.dtype, device=x.device).index_add_(0, node_batch, x)
+    mean = mean / counts.clamp(min=1).view(-1, 1).to(x.dtype)
+    x = torch.where(mask.view(-1, 1), mean[node_batch], x)
+    return Batch(x=x, edge_index=batch.edge_index, batch=node_batch, ptr=batch.ptr)
+
+
+def batch_graph_views(batch, aug='random', aug_ratio=0.1, generator=None):
+    """
+    graph_views for a collated Batch. aug_ratio is a float, a per-graph tensor or a (low, high) range.
+    """
+    if aug == 'random':
+        aug = 'dropN' if coin(generator) else 'permE'
+    if aug == 'dropN':
+        return batch_drop_nodes(batch, aug_ratio, generator)
+    elif aug == 'permE':
+        return batch_permute_edges(batch, aug_ratio, generator)
+    elif aug == 'maskN':
+        return batch_mask_nodes(batch, aug_ratio, generator)
+    raise ValueError("aug should be dropN, permE, maskN or random but got {}".format(aug))
+
+
+def concat_views(view1, view2):
+    """
+    both views as one disjoint batch, so that one encoder forward embeds them: graphs [0, B) are view1 and
+    graphs [B, 2B) are view2.
+    :return: x, edge_index, batch
+    """
+    x = torch.cat([view1.x, view2.x], dim=0)
+    edge_index = torch.cat([view1.edge_index, view2.edge_index + view1.x.shape[0]], dim=1)
+    batch = torch.cat([view1.batch, view2.batch + view1.num_graphs])
+    return x, edge_index, batch
+
+
+# the former python implementations, kept for the benchmark only
+def legacy_drop_nodes(data, aug_ratio):
+    node_num, _ = data.x.size()
+    _, edge_num = data.edge_index.size()
+    drop_num = int(node_num * aug_ratio)
+
+    idx_perm = np.random.permutation(node_num)
+
+    idx_drop = idx_perm[:drop_num]
+    idx_nondrop = idx_perm[drop_num:]
+    idx_nondrop.sort()
+    idx_dict = {idx_nondrop[n]: n for n in list(range(idx_nondrop.shape[0]))}
+
+    edge_index = data.edge_index.numpy()
+
+    edge_index = [[idx_dict[edge_index[0, n]], idx_dict[edge_index[1, n]]] for n in range(edge_num) if
+                  (not edge_index[0, n] in idx_drop) and (not edge_index[1, n] in idx_drop)]
+    try:
+        data.edge_index = torch.tensor(edge_index).transpose_(0, 1)
+        data.x = data.x[idx_nondrop]
+    except:
+        data = data
+
+    return data
+
+
+def legacy_permute_edges(data, aug_ratio):
+    _, edge_num = data.edge_index.size()
+    permute_num = int(edge_num * aug_ratio)
+    idx_delete = np.random.choice(edge_num, (edge_num - permute_num), replace=False)
+    data.edge_index = data.edge_index[:, idx_delete]
+    return data
+
+
+def legacy_mask_nodes(data, aug_ratio):
+    node_num, feat_dim = data.x.size()
+    mask_num = int(node_num * aug_ratio)
+    token = data.x.mean(dim=0)
+    idx_mask = np.random.choice(node_num, mask_num, replace=False)
+    data.x[idx_mask] = token.clone().detach()
+    return data
+
+
+def benchmark(sizes=(100, 1000, 10000, 100000), avg_degree=4, feat_dim=64, aug_ratio=0.2, repeat=3,
+              legacy_max_nodes=10000):
+    """
+    seconds per call of the tensor augmentations and the legacy ones on random graphs of the given sizes.
+    the legacy drop_nodes is O(E*N), it is skipped above legacy_max_nodes nodes.
+    """
+    from torch_geometric.data import Data
+
+    pairs = [('dropN', drop_nodes, legacy_drop_nodes), ('permE', permute_edges, legacy_permute_edges),
+             ('maskN', mask_nodes, legacy_mask_nodes)]
+    report = []
+    for n in sizes:
+        graph = Data(x=torch.randn(n, feat_dim), edge_index=torch.randint(n, (2, n * avg_degree)))
+        for name, fn, legacy_fn in pairs:
+            row = {'nodes': n, 'aug': name}
+            for key, f in [('tensor', fn), ('legacy', legacy_fn)]:
+                if key == 'legacy' and name == 'dropN' and n > legacy_max_nodes:
+                    row[key] = None
+                    continue
+                best = float('inf')
+                for _ in range(repeat):
+                    g = Data(x=graph.x.clone(), edge_index=graph.edge_index.clone())
+                    start = time.perf_counter()
+                    f(g, aug_ratio)
+                    best = min(best, time.perf_counter() - start)
+                row[key] = best
+            row['speedup'] = row['legacy'] / row['tensor'] if row['legacy'] is not None else None
+            report.append(row)
+            print("{:>7} nodes | {} | tensor {:.6f}s | legacy {} | speedup {}".format(
+                n, name, row['tensor'],
+                '{:.6f}s'.format(row['legacy']) if row['legacy'] is not None else 'skipped',
+                '{:.1f}x'.format(row['speedup']) if row['speedup'] is not None else '-'))
+    return report
+
+
+if __name__ == '__main__':
+    benchmark()
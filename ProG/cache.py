@@ -0,0 +1,162 @@
+import os
+import hashlib
+from collections import OrderedDict
+
+import torch
+from torch_geometric.data import Batch, Data
+
+
+def tensor_digest(h, t):
+    t = t.detach().cpu().contiguous()
+    h.update(str((t.dtype, tuple(t.shape))).encode())
+    h.update(t.view(-1).view(torch.uint8).numpy().tobytes())
+
+
+def autocast_state(device_type):
+    """
+    autocast dtype active for device_type, part of the cache key: embeddings of a bf16 forward are not served to an
+    fp32 one, and the other way around
+    """
+    if device_type == 'cuda' and torch.is_autocast_enabled():
+        return 'autocast-' + str(torch.get_autocast_gpu_dtype())
+    if device_type == 'cpu' and torch.is_autocast_cpu_enabled():
+        return 'autocast-' + str(torch.get_autocast_cpu_dtype())
+    return 'fp32'
+
+
+class GraphEmbeddingCache:
+    def __init__(self, max_items=None, spill_dir=None):
+        """
+        graph embeddings of a frozen GNN, keyed by graph content plus a fingerprint of the model weights and the
+        autocast state of the forward, so the same graph is embedded only once no matter which mini-batch it
+        shows up in.
+
+        :param max_items: number of embeddings kept in memory. beyond it, the least recently used ones are
+                          dropped, or written to spill_dir if it is given. None means no limit.
+        :param spill_dir: folder for embeddings spilled out of memory
+        """
+        self.max_items = max_items
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+        self.memory = OrderedDict()
+        self._fingerprints = {}
+        self.hits = 0
+        self.misses = 0
+
+    def model_fingerprint(self, model):
+        """
+        hash of all weights of model. it is recomputed only when some weight is replaced or updated in place.
+        """
+        tensors = list(model.parameters()) + list(model.buffers())
+        state = tuple((t.data_ptr(), t._version) for t in tensors)
+        cached = self._fingerprints.get(id(model))
+        if cached is not None and cached[0] == state:
+            return cached[1]
+
+        h = hashlib.sha1(type(model).__name__.encode())
+        for t in tensors:
+            tensor_digest(h, t)
+        fingerprint = h.hexdigest()
+        self._fingerprints[id(model)] = (state, fingerprint)
+        return fingerprint
+
+    @staticmethod
+    def graph_key(x, edge_index):
+        h = hashlib.sha1()
+        tensor_digest(h, x)
+        tensor_digest(h, edge_index)
+        return h.hexdigest()
+
+    @classmethod
+    def tag_graphs(cls, data_list):
+        """
+        stores the content key of every graph of data_list on it as graph_key, computed once. batches of tagged
+        graphs carry the keys (PyG collates strings into a list) and embed() does not hash them again.
+        """
+        for data in data_list:
+            data.graph_key = cls.graph_key(data.x, data.edge_index)
+        return data_list
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.spill_dir is not None:
+            path = os.path.join(self.spill_dir, key + '.pt')
+            if os.path.exists(path):
+                emb = torch.load(path)
+                self.put(key, emb)
+                return emb
+        return None
+
+    def put(self, key, emb):
+        self.memory[key] = emb
+        self.memory.move_to_end(key)
+        while self.max_items is not None and len(self.memory) > self.max_items:
+            old_key, old_emb = self.memory.popitem(last=False)
+            if self.spill_dir is not None:
+                path = os.path.join(self.spill_dir, old_key + '.pt')
+                if not os.path.exists(path):
+                    torch.save(old_emb, path)
+
+    def clear(self):
+        self.memory.clear()
+        self._fingerprints.clear()
+
+    def embed(self, model, graph_batch: Batch):
+        """
+        same as model(graph_batch.x, graph_batch.edge_index, graph_batch.batch), but only the graphs that are not
+        cached yet go through model. if model has trainable weights, the cache is bypassed.
+        :return: graph embeddings, one row per graph of graph_batch, on the device of graph_batch
+        """
+        if any(p.requires_grad for p in model.parameters()):
+            return model(graph_batch.x, graph_batch.edge_index, graph_batch.batch)
+
+        device = graph_batch.x.device
+        num_graphs = graph_batch.num_graphs
+        fingerprint = self.model_fingerprint(model) + '.' + autocast_state(device.type)
+
+        node_batch, edge_index = graph_batch.batch, graph_batch.edge_index
+        ptrs = []
+
+        def graph(i):
+            # node and edge offsets of the graphs, only computed when some graph has to be sliced out
+            if len(ptrs) == 0:
+                node_count = torch.bincount(node_batch, minlength=num_graphs)
+                edge_count = torch.bincount(node_batch[edge_index[0]], minlength=num_graphs)
+                ptrs.append([0] + torch.cumsum(node_count, 0).tolist())
+                ptrs.append([0] + torch.cumsum(edge_count, 0).tolist())
+            node_ptr, edge_ptr = ptrs
+            return graph_batch.x[node_ptr[i]:node_ptr[i + 1]], edge_index[:, edge_ptr[i]:edge_ptr[i + 1]] - node_ptr[i]
+
+        # graphs tagged by tag_graphs carry their key, the others are hashed here
+        graph_keys = getattr(graph_batch, 'graph_key', None)
+        if graph_keys is None:
+            graph_keys = [self.graph_key(*graph(i)) for i in range(num_graphs)]
+
+        keys, found, missing = [], {}, OrderedDict()
+        for i in range(num_graphs):
+            key = fingerprint + '.' + graph_keys[i]
+            keys.append(key)
+            if key in found or key in missing:
+                continue
+            emb = self.get(key)
+            if emb is None:
+                g_x, g_edge_index = graph(i)
+                missing[key] = Data(x=g_x, edge_index=g_edge_index)
+            else:
+                found[key] = emb
+
+        self.hits += num_graphs - len(missing)
+        self.misses += len(missing)
+        if len(missing) > 0:
+            missing_batch = Batch.from_data_list(list(missing.values()))
+            with torch.no_grad():
+                emb = model(missing_batch.x, missing_batch.edge_index, missing_batch.batch).cpu()
+            for key, e in zip(missing.keys(), emb):
+                found[key] = e
+                self.put(key, e)
+
+        return torch.stack([found[key] for key in keys]).to(device)
@@ -0,0 +1,118 @@
+import math
+import time
+from itertools import cycle, islice
+
+import torch
+
+
+def bucket_size(n, base=64, growth=1.5):
+    """
+    smallest size of the form base, ceil(base * growth), ... that is >= n
+    """
+    size = base
+    while size < n:
+        size = int(math.ceil(size * growth))
+    return size
+
+
+def pad_graph_batch(x, edge_index, batch, num_nodes, num_edges, num_graphs=None):
+    """
+    pads a batch of graphs to fixed sizes. padded nodes have zero features and belong to the last graph slot
+    num_graphs - 1, padded edges are self loops of the first padded node, so real nodes never see the padding.
+
+    :param num_nodes: > x.shape[0], so that there is always a padded node
+    :param num_graphs: > number of real graphs, so that the padded graph slot is always the last one
+    :return: x, edge_index, batch (None if batch is None), mask of the real nodes
+    """
+    real_nodes, real_edges = x.shape[0], edge_index.shape[1]
+    x = torch.cat([x, x.new_zeros(num_nodes - real_nodes, x.shape[1])])
+    edge_index = torch.cat([edge_index, edge_index.new_full((2, num_edges - real_edges), real_nodes)], dim=1)
+    if batch is not None:
+        batch = torch.cat([batch, batch.new_full((num_nodes - real_nodes,), num_graphs - 1)])
+    mask = torch.arange(num_nodes, device=x.device) < real_nodes
+    return x, edge_index, batch, mask
+
+
+class CompiledGNN(torch.nn.Module):
+    def __init__(self, gnn, node_base=64, edge_base=256, graph_base=8, growth=1.5, backend='inductor', mode=None):
+        """
+        torch.compile wrapper of a GNN for batches whose sizes change on every step (induced graphs, prompted
+        graphs). node, edge and graph counts are padded up to a few buckets (see bucket_size), and one compiled
+        module is kept per bucket, so after warm-up no step recompiles.
+        it is called like the GNN and returns the same embeddings, without the padding.
+        """
+        super().__init__()
+        self.gnn = gnn
+        self.node_base = node_base
+        self.edge_base = edge_base
+        self.graph_base = graph_base
+        self.growth = growth
+        self.backend = backend
+        self.mode = mode
+        self.compiled = {}
+
+    def bucket(self, x, edge_index, num_graphs=None):
+        num_nodes = bucket_size(x.shape[0] + 1, self.node_base, self.growth)
+        num_edges = bucket_size(edge_index.shape[1], self.edge_base, self.growth)
+        if num_graphs is not None:
+            num_graphs = bucket_size(num_graphs + 1, self.graph_base, self.growth)
+        return num_nodes, num_edges, num_graphs
+
+    def forward(self, x, edge_index, batch=None, prompt=None, num_graphs=None):
+        """
+        :param num_graphs: number of graphs of batch, e.g. Batch.num_graphs (read from ptr). if it is not given it
+                           is read from batch, which syncs with the device on every call.
+        """
+        if num_graphs is None and batch is not None:
+            num_graphs = int(batch.max()) + 1
+        key = self.bucket(x, edge_index, num_graphs)
+        fn = self.compiled.get(key)
+        if fn is None:
+            fn = torch.compile(self.gnn, backend=self.backend, mode=self.mode, dynamic=False)
+            self.compiled[key] = fn
+
+        px, pedge_index, pbatch, mask = pad_graph_batch(x, edge_index, batch, *key)
+        # every bucket is a different static shape for dynamo: its cache has to hold them all, but only during
+        # this call, the limit of the other compiled modules of the process is left as it is
+        cache_size_limit = max(torch._dynamo.config.cache_size_limit, len(self.compiled))
+        with torch._dynamo.config.patch(cache_size_limit=cache_size_limit):
+            out = fn(px, pedge_index, pbatch, prompt)
+        if batch is None:
+            return out[mask]
+        return out[:num_graphs]
+
+
+def benchmark(gnn, loader, pipeline=None, steps=50, **compile_kwargs):
+    """
+    graphs per second of eager vs compiled inference, over the first steps batches of loader.
+    every batch is run once before timing, so that the compiled buckets are warm.
+
+    :param pipeline: pipeline(graph_batch, gnn) -> output, e.g. a FrontAndHead. default gnn on the batch itself.
+    """
+    if pipeline is None:
+        def pipeline(b, g):
+            # the compiled wrapper takes the graph count from ptr instead of syncing on batch.max()
+            kwargs = {'num_graphs': b.num_graphs} if isinstance(g, CompiledGNN) else {}
+            return g(b.x, b.edge_index, b.batch, **kwargs)
+    device = next(gnn.parameters()).device
+    batches = [b.to(device) for b in islice(cycle(loader), steps)]
+    num_graphs = sum(b.num_graphs for b in batches)
+
+    report = {}
+    for name, g in [('eager', gnn), ('compiled', CompiledGNN(gnn, **compile_kwargs))]:
+        with torch.no_grad():
+            for b in batches:
+                pipeline(b, g)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for b in batches:
+                pipeline(b, g)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start
+        report[name] = num_graphs / elapsed
+        print("{} | {:.1f} graphs/s".format(name, report[name]))
+    report['speedup'] = report['compiled'] / report['eager']
+    print("speedup: {:.2f}x".format(report['speedup']))
+    return report
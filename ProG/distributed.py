@@ -0,0 +1,129 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend='gloo'):
+    """
+    joins the process group of a torchrun launch (RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT come from the
+    environment), e.g. torchrun --nproc_per_node=8 -m ProG.pre_train
+    the cpu cores of the host are split between the local workers so that they do not oversubscribe it.
+    :return: rank, world_size. (0, 1) when the script was not launched by torchrun.
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend, init_method='env://')
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def shard(items):
+    """
+    items[rank::world_size] of this worker. shards are padded by wrapping around, so that every worker gets the
+    same number of items, hence the same number of steps (and of gradient all-reduces).
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return items
+    per_worker = -(-len(items) // world_size)
+    index = [(get_rank() + i * world_size) % len(items) for i in range(per_worker)]
+    if torch.is_tensor(items):
+        return items[torch.tensor(index, device=items.device)]
+    return [items[i] for i in index]
+
+
+def broadcast_parameters(module, src=0):
+    """
+    copies the weights and buffers of module on rank src to all workers, so that they start from the same model
+    """
+    if not is_distributed():
+        return
+    for t in module.state_dict().values():
+        dist.broadcast(t, src)
+
+
+def all_reduce_gradients(module):
+    """
+    averages the gradients of module over all workers, with one all-reduce over a flattened buffer.
+    called between loss.backward() and optimizer.step().
+    """
+    if not is_distributed():
+        return
+    params = [p for p in module.parameters() if p.requires_grad]
+    if len(params) == 0:
+        return
+    # parameters without gradient on this worker still take part, so that all buffers have the same layout
+    grads = [p.grad if p.grad is not None else torch.zeros_like(p) for p in params]
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= get_world_size()
+
+    offset = 0
+    for p in params:
+        numel = p.numel()
+        p.grad = flat[offset:offset + numel].view_as(p).clone()
+        offset += numel
+
+
+def all_reduce_tensors(*tensors):
+    """
+    sums tensors over all workers, in place
+    """
+    if not is_distributed():
+        return tensors
+    for t in tensors:
+        dist.all_reduce(t)
+    return tensors
+
+
+def broadcast_tensors(*tensors, src=0):
+    """
+    copies tensors of rank src to all workers, in place
+    """
+    if not is_distributed():
+        return tensors
+    for t in tensors:
+        dist.broadcast(t, src)
+    return tensors
+
+
+def all_reduce_mean(value):
+    """
+    mean of a python number over all workers
+    """
+    if not is_distributed():
+        return value
+    t = torch.tensor([float(value)], dtype=torch.float64)
+    dist.all_reduce(t)
+    return t.item() / get_world_size()
+
+
+def all_reduce_sum(value):
+    """
+    sum of a python number over all workers
+    """
+    if not is_distributed():
+        return value
+    t = torch.tensor([float(value)], dtype=torch.float64)
+    dist.all_reduce(t)
+    return t.item()
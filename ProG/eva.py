@@ -173,7 +173,10 @@ def mrr_hit(normal_label: np.ndarray, pos_out: np.ndarray, metric: list = None):
     return results
 
 
-def acc_f1_over_batches(test_loader, PG, gnn, answering, num_class, task_type, device):
+def acc_f1_over_batches(test_loader, PG, gnn, answering, num_class, task_type, device, emb_cache=None):
+    """
+    :param emb_cache: a GraphEmbeddingCache for the frozen gnn, used when answering is None
+    """
     PG = PG.to("cpu")
     if answering is not None:
         answering = answering.to("cpu")
@@ -197,7 +200,10 @@ def acc_f1_over_batches(test_loader, PG, gnn, answering, num_class, task_type, d
             # print(graph_emb)
             pre = answering(graph_emb)
         else:  # if answering is None
-            emb0 = gnn(test_batch.x, test_batch.edge_index, test_batch.batch)
+            if emb_cache is not None:
+                emb0 = emb_cache.embed(gnn, test_batch)
+            else:
+                emb0 = gnn(test_batch.x, test_batch.edge_index, test_batch.batch)
             pg_batch = PG.token_view()
             pg_emb = gnn(pg_batch.x, pg_batch.edge_index, pg_batch.batch)
             dot = torch.mm(emb0, torch.transpose(pg_emb, 0, 1))
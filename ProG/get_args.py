@@ -1,8 +1,11 @@
 import argparse
-from dgl.data import register_data_args
-def get_my_args():
+def get_my_args(args=None):
+    """
+    :param args: list of arguments to parse, None reads the command line. unknown arguments (e.g. the ones of
+                 torchrun) are ignored.
+    """
     parser = argparse.ArgumentParser(description='GraphSAGE')
-    register_data_args(parser)
+    parser.add_argument("--dataset", type=str, default='citeseer', help="dataset name")
     parser.add_argument("--dropout", type=float, default=0.5,help="dropout probability")
     parser.add_argument("--lr_c", type=float, default=0.01,help="learning rate")
     parser.add_argument("--seed", type=int, default=100,help="random seed")
@@ -11,7 +14,7 @@ def get_my_args():
     parser.add_argument("--weight-decay", type=float, default=5e-4,help="Weight for L2 loss")
     parser.add_argument("--aggregator-type", type=str, default="mean")
     parser.add_argument('--num-workers', type=int, default=0)
-    parser.add_argument('--sample-list', type=list, default=[4,4])
+    parser.add_argument('--sample-list', type=int, nargs='+', default=[4,4],help="neighbors sampled per layer")
     parser.add_argument("--n-epochs", type=int, default=30,help="number of training epochs")
     parser.add_argument("--file-id", type=str, default='128')
     parser.add_argument("--gpu", type=int, default=1,help="gpu")
@@ -20,7 +23,10 @@ def get_my_args():
     parser.add_argument('--half', type=bool, default=False)
     parser.add_argument('--mask_rate', type=float, default=0)
     parser.add_argument('--center_num', type=int, default=7)
-    args = parser.parse_args(args=['--dataset','citeseer'])
+    parser.add_argument('--mini-batch', action='store_true', help="node_task: train on sampled neighborhoods")
+    # bfloat16 forward passes (see utils.mixed_precision), the prompt similarities stay in fp32
+    parser.add_argument('--amp', action='store_true', help="mixed precision forward passes")
+    args, _ = parser.parse_known_args(args)
     print(args)
     return args
 
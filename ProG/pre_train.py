@@ -1,13 +1,64 @@
+import math
+import time
+from copy import deepcopy
+
 import torch
 import torch.optim as optim
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint as checkpoint_fn
 from torch.autograd import Variable
 from torch_geometric.loader import DataLoader
 from torch_geometric.data import Data
 from random import shuffle
 import random
 
-from Model.model import GNN
-from utils import gen_ran_output,load_data4pretrain,mkdir, graph_views
+from torch_geometric.data import Batch
+
+from .Model.model import GNN
+from .utils import gen_ran_output,load_data4pretrain,mkdir, graph_views, mixed_precision, fp32_region
+from .augment import batch_graph_views, concat_views
+from .registry import CheckpointRegistry
+from .distributed import init_distributed, shard, broadcast_parameters, all_reduce_gradients, all_reduce_mean, \
+    is_main_process
+
+class GraphViewDataset(torch.utils.data.Dataset):
+    def __init__(self, graph_list, aug1, aug2, aug_ratio):
+        """
+        pairs of GraphCL views drawn on the fly: every access augments the source graph again, so every epoch sees
+        fresh views and only the source graphs are kept in memory.
+        """
+        self.graph_list = graph_list
+        self.aug1 = aug1
+        self.aug2 = aug2
+        self.aug_ratio = aug_ratio
+
+    def __len__(self):
+        return len(self.graph_list)
+
+    def view(self, g, aug):
+        # the augmentations return a new graph, the source one is shared by both views and never changed
+        view_g = graph_views(data=g, aug=aug, aug_ratio=self.aug_ratio)
+        return Data(x=view_g.x, edge_index=view_g.edge_index)
+
+    def __getitem__(self, idx):
+        g = self.graph_list[idx]
+        return self.view(g, self.aug1), self.view(g, self.aug2)
+
+
+def info_nce_rows(z1, keys, start, T):
+    """
+    loss of the rows start..start+len(z1) of the batch: -s_ii / T + log(sum_{j != i} exp(s_ij / T) + 1e-4), where the
+    positive of row i is keys[start + i] and all other keys are negatives. the 1e-4 of the original loss is one more
+    logit log(1e-4), so a row without negatives (batch of a single graph) stays finite.
+    """
+    sim = z1 @ keys.t() / T
+    rows = torch.arange(z1.shape[0], device=z1.device)
+    pos_mask = torch.zeros_like(sim, dtype=torch.bool)
+    pos_mask[rows, start + rows] = True
+    pos = sim[rows, start + rows]
+    neg = torch.cat([sim.masked_fill(pos_mask, float('-inf')), sim.new_full((sim.shape[0], 1), math.log(1e-4))], dim=1)
+    return torch.logsumexp(neg, dim=1) - pos
+
 
 class GraphCL(torch.nn.Module):
 
@@ -23,28 +74,59 @@ class GraphCL(torch.nn.Module):
         x = self.projection_head(x)
         return x
 
-    def loss_cl(self, x1, x2):
+    def forward(self, x, edge_index, batch):
+        # the module call used by utils.gen_ran_output (functional_call)
+        return self.forward_cl(x, edge_index, batch)
+
+    @fp32_region
+    def loss_cl(self, x1, x2, queue=None, chunk_size=1024):
+        """
+        -mean_i log(exp(s_ii / T) / (sum_{j != i} exp(s_ij / T) + 1e-4)) + 10, s the cosine similarity of x1 and x2.
+        computed in log space (logsumexp, no exp overflow) over chunks of chunk_size rows, and the chunks are
+        recomputed in backward, so only one chunk_size x batch_size block of similarities is alive at a time.
+        :param queue: [K, hid_dim] normalized embeddings of earlier batches (see PreTrain queue_size), extra
+                      negatives of every row
+        """
         T = 0.1
-        batch_size, _ = x1.size()
-        x1_abs = x1.norm(dim=1)
-        x2_abs = x2.norm(dim=1)
-        sim_matrix = torch.einsum('ik,jk->ij', x1, x2) / torch.einsum('i,j->ij', x1_abs, x2_abs)
-        sim_matrix = torch.exp(sim_matrix / T)
-        pos_sim = sim_matrix[range(batch_size), range(batch_size)]
-        loss = pos_sim / ((sim_matrix.sum(dim=1) - pos_sim) + 1e-4)
-        loss = - torch.log(loss).mean() + 10
+        z1 = F.normalize(x1, dim=1)
+        z2 = F.normalize(x2, dim=1)
+        keys = z2 if queue is None else torch.cat([z2, queue.to(z2.dtype)])
+        losses = []
+        for start in range(0, z1.shape[0], chunk_size):
+            args = (z1[start:start + chunk_size], keys, start, T)
+            if torch.is_grad_enabled() and z1.shape[0] > chunk_size:
+                losses.append(checkpoint_fn(info_nce_rows, *args, use_reentrant=False))
+            else:
+                losses.append(info_nce_rows(*args))
+        loss = torch.cat(losses).mean() + 10
         return loss
 
 
 class PreTrain(torch.nn.Module):
     def __init__(self, pretext="GraphCL", gnn_type='TransformerConv',
-                 input_dim=None, hid_dim=None, gln=2):
+                 input_dim=None, hid_dim=None, gln=2, checkpoint=False, amp=False, queue_size=0, momentum=0.999):
+        """
+        :param checkpoint: activation checkpointing of the GNN layers (True for all of them, or a list of layer
+                           indices), see GNN
+        :param amp: bfloat16 mixed precision forward passes on cpu (see utils.mixed_precision),
+                    loss_cl stays in fp32
+        :param queue_size: GraphCL only. > 0 embeds the second view with a momentum copy of the model (MoCo), whose
+                           last queue_size embeddings are kept as extra negatives of loss_cl
+        :param momentum: weight of the momentum encoder in its update, key = momentum * key + (1 - momentum) * model
+        """
         super(PreTrain, self).__init__()
         self.pretext = pretext
         self.gnn_type=gnn_type
+        self.amp = amp
+        self.batch_augs = None
+        self.queue_size = queue_size
+        self.momentum = momentum
+        self.key_model = None
+        self.queue = None
+        self.dims = dict(input_dim=input_dim, hid_dim=hid_dim, num_layer=gln)
 
-        self.gnn = GNN(input_dim=input_dim, hid_dim=hid_dim, out_dim=hid_dim, gcn_layer_num=gln, pool=None,
-                       gnn_type=gnn_type)
+        self.gnn = GNN(input_dim=input_dim, hid_dim=hid_dim, out_dim=hid_dim, num_layer=gln, pool='mean',
+                       gnn_type=gnn_type, checkpoint=checkpoint)
 
         if pretext in ['GraphCL', 'SimGRACE']:
             self.model = GraphCL(self.gnn, hid_dim=hid_dim)
@@ -52,23 +134,50 @@ class PreTrain(torch.nn.Module):
             raise ValueError("pretext should be GraphCL, SimGRACE")
 
     def get_loader(self, graph_list, batch_size,
-                   aug1=None, aug2=None, aug_ratio=None, pretext="GraphCL"):
-
-        if len(graph_list) % batch_size == 1:
-            raise KeyError(
-                "batch_size {} makes the last batch only contain 1 graph, \n which will trigger a zero bug in GraphCL!")
-
+                   aug1=None, aug2=None, aug_ratio=None, pretext="GraphCL", aug_mode='stream', num_workers=1,
+                   prefetch_factor=2):
+        """
+        :param aug_mode: 'stream': GraphCL views are drawn by the loader workers at every epoch (GraphViewDataset),
+                         the loader yields (view 1 batch, view 2 batch) and loader2 is None.
+                         'precomputed': both views are drawn once before training, one loader per view.
+                         'batch': the loader yields collated source graphs, train_graphcl draws both views from each
+                         batch on the device (augment.batch_graph_views) and embeds them with one encoder forward.
+        :param num_workers: loader workers, they persist across epochs and prefetch prefetch_factor batches each
+        """
+
+        self.batch_augs = None
         if pretext == 'GraphCL':
             shuffle(graph_list)
             if aug1 is None:
-                aug1 = random.sample(['dropN', 'permE', 'maskN'], k=1)
+                aug1 = random.choice(['dropN', 'permE', 'maskN'])
             if aug2 is None:
-                aug2 = random.sample(['dropN', 'permE', 'maskN'], k=1)
+                aug2 = random.choice(['dropN', 'permE', 'maskN'])
             if aug_ratio is None:
                 aug_ratio = random.randint(1, 3) * 1.0 / 10  # 0.1,0.2,0.3
 
             print("===graph views: {} and {} with aug_ratio: {}".format(aug1, aug2, aug_ratio))
 
+            if aug_mode == 'batch':
+                self.batch_augs = (aug1, aug2, aug_ratio)
+                kwargs = {}
+                if num_workers > 0:
+                    kwargs.update(persistent_workers=True, prefetch_factor=prefetch_factor)
+                source_list = [Data(x=g.x, edge_index=g.edge_index) for g in graph_list]
+                loader = DataLoader(source_list, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                                    **kwargs)
+                return loader, None
+            elif aug_mode == 'stream':
+                kwargs = {}
+                if num_workers > 0:
+                    kwargs.update(persistent_workers=True, prefetch_factor=prefetch_factor)
+                # the augmentations draw from the torch RNG, which the DataLoader seeds differently in every worker.
+                # both views of a graph come from the same item, so the loader can shuffle
+                loader = DataLoader(GraphViewDataset(graph_list, aug1, aug2, aug_ratio), batch_size=batch_size,
+                                    shuffle=True, num_workers=num_workers, **kwargs)
+                return loader, None
+            elif aug_mode != 'precomputed':
+                raise ValueError("aug_mode should be stream, batch or precomputed")
+
             view_list_1 = []
             view_list_2 = []
             for g in graph_list:
@@ -91,18 +200,71 @@ class PreTrain(torch.nn.Module):
         else:
             raise ValueError("pretext should be GraphCL, SimGRACE")
 
+    @property
+    def device(self):
+        # batches follow the model: move it with pt.model.to(device) before training
+        return next(self.model.parameters()).device
+
+    def loader_benchmark(self, graph_list, batch_size=10, aug1='dropN', aug2='permE', aug_ratio=0.2, epochs=3,
+                         num_workers=1):
+        """
+        graphs per second delivered by the GraphCL loaders of every aug_mode over epochs epochs, views included
+        (drawn before training for 'precomputed', on the device by train_graphcl for 'batch'), no model step.
+        """
+        device = self.device
+        report = {}
+        for aug_mode in ['precomputed', 'stream', 'batch']:
+            start = time.perf_counter()
+            loader1, loader2 = self.get_loader(list(graph_list), batch_size, aug1=aug1, aug2=aug2, aug_ratio=aug_ratio,
+                                               pretext='GraphCL', aug_mode=aug_mode, num_workers=num_workers)
+            for epoch in range(epochs):
+                for batch in (zip(loader1, loader2) if loader2 is not None else loader1):
+                    if aug_mode == 'batch':
+                        batch = batch.to(device)
+                        concat_views(batch_graph_views(batch, aug1, aug_ratio), batch_graph_views(batch, aug2, aug_ratio))
+            report[aug_mode] = len(graph_list) * epochs / (time.perf_counter() - start)
+            print("{} | {:.1f} graphs/s".format(aug_mode, report[aug_mode]))
+        self.batch_augs = None
+        return report
+
+    def init_momentum_encoder(self):
+        """
+        the momentum encoder starts as a copy of the model, on its device, with an empty queue
+        """
+        self.key_model = deepcopy(self.model)
+        self.key_model.requires_grad_(False)
+        param = next(self.model.parameters())
+        self.queue = param.new_zeros(0, self.dims['hid_dim'])
+
+    @torch.no_grad()
+    def momentum_update(self, keys):
+        for key_param, param in zip(self.key_model.parameters(), self.model.parameters()):
+            key_param.mul_(self.momentum).add_(param.detach(), alpha=1 - self.momentum)
+        # newest keys first, the oldest ones fall out of the queue
+        self.queue = torch.cat([F.normalize(keys.detach().float(), dim=1), self.queue])[:self.queue_size]
+
+    def memory_report(self, graph_list, batch_size=10):
+        """
+        activation memory of the GNN on one batch of graph_list, without and with checkpointing
+        """
+        batch = Batch.from_data_list(graph_list[:batch_size]).to(self.device)
+        return self.gnn.memory_report(batch.x, batch.edge_index, batch.batch)
+
     def train_simgrace(self, model, loader, optimizer):
+        device = self.device
         model.train()
         train_loss_accum = 0
         total_step = 0
         for step, data in enumerate(loader):
             optimizer.zero_grad()
             data = data.to(device)
-            x2 = gen_ran_output(data, model) 
-            x1 = model.forward_cl(data.x, data.edge_index, data.batch)
-            x2 = Variable(x2.detach().data.to(device), requires_grad=False)
-            loss = model.loss_cl(x1, x2)
+            with mixed_precision(self.amp, device_type=device.type):
+                x2 = gen_ran_output(data, model) 
+                x1 = model.forward_cl(data.x, data.edge_index, data.batch)
+                x2 = Variable(x2.detach().data.to(device), requires_grad=False)
+                loss = model.loss_cl(x1, x2)
             loss.backward()
+            all_reduce_gradients(model)
             optimizer.step()
             train_loss_accum += float(loss.detach().cpu().item())
             total_step = total_step + 1
@@ -110,18 +272,42 @@ class PreTrain(torch.nn.Module):
         return train_loss_accum / total_step
 
     def train_graphcl(self, model, loader1, loader2, optimizer):
+        device = self.device
         model.train()
         train_loss_accum = 0
         total_step = 0
-        for step, batch in enumerate(zip(loader1, loader2)):
-            batch1, batch2 = batch
+        # a streaming loader yields both views itself
+        batches = zip(loader1, loader2) if loader2 is not None else loader1
+        for step, batch in enumerate(batches):
             optimizer.zero_grad()
-            x1 = model.forward_cl(batch1.x.to(device), batch1.edge_index.to(device), batch1.batch.to(device))
-            x2 = model.forward_cl(batch2.x.to(device), batch2.edge_index.to(device), batch2.batch.to(device))
-            loss = model.loss_cl(x1, x2)
+            if self.batch_augs is not None:
+                aug1, aug2, aug_ratio = self.batch_augs
+                batch = batch.to(device)
+                batch1, batch2 = batch_graph_views(batch, aug1, aug_ratio), batch_graph_views(batch, aug2, aug_ratio)
+            else:
+                batch1, batch2 = batch[0].to(device), batch[1].to(device)
+
+            with mixed_precision(self.amp, device_type=device.type):
+                if self.key_model is not None:
+                    x1 = model.forward_cl(batch1.x, batch1.edge_index, batch1.batch)
+                    with torch.no_grad():
+                        x2 = self.key_model.forward_cl(batch2.x, batch2.edge_index, batch2.batch)
+                    loss = model.loss_cl(x1, x2, queue=self.queue)
+                elif self.batch_augs is not None:
+                    # one encoder forward: graphs [0, B) are the first view, [B, 2B) the second one
+                    num_graphs = batch1.num_graphs
+                    z = model.forward_cl(*concat_views(batch1, batch2))
+                    loss = model.loss_cl(z[:num_graphs], z[num_graphs:])
+                else:
+                    x1 = model.forward_cl(batch1.x, batch1.edge_index, batch1.batch)
+                    x2 = model.forward_cl(batch2.x, batch2.edge_index, batch2.batch)
+                    loss = model.loss_cl(x1, x2)
 
             loss.backward()
+            all_reduce_gradients(model)
             optimizer.step()
+            if self.key_model is not None:
+                self.momentum_update(x2)
 
             train_loss_accum += float(loss.detach().cpu().item())
             total_step = total_step + 1
@@ -129,10 +315,18 @@ class PreTrain(torch.nn.Module):
         return train_loss_accum / total_step
 
     def train(self, dataname, graph_list, batch_size=10, aug1='dropN', aug2="permE", aug_ratio=None, lr=0.01,
-              decay=0.0001, epochs=100):
-
+              decay=0.0001, epochs=100, aug_mode='stream'):
+        """
+        under torchrun (see distributed.init_distributed), every worker trains on its shard of graph_list,
+        gradients are averaged over the workers and only rank 0 saves the model.
+        """
+        # every worker starts from the weights of rank 0
+        broadcast_parameters(self.model)
+        if self.pretext == 'GraphCL' and self.queue_size > 0:
+            self.init_momentum_encoder()
+        graph_list = shard(graph_list)
         loader1, loader2 = self.get_loader(graph_list, batch_size, aug1=aug1, aug2=aug2,
-                                           pretext=self.pretext)
+                                           pretext=self.pretext, aug_mode=aug_mode)
         # print('start training {} | {} | {}...'.format(dataname, pre_train_method, gnn_type))
         optimizer = optim.Adam(self.model.parameters(), lr=lr, weight_decay=decay)
 
@@ -144,13 +338,18 @@ class PreTrain(torch.nn.Module):
                 train_loss = self.train_simgrace(self.model, loader1, optimizer)
             else:
                 raise ValueError("pretext should be GraphCL, SimGRACE")
+            # all workers see the same loss, so they agree on the best epoch
+            train_loss = all_reduce_mean(train_loss)
+            if not is_main_process():
+                continue
 
             print("***epoch: {}/{} | train_loss: {:.8}".format(epoch, epochs, train_loss))
 
             if train_loss_min > train_loss:
                 train_loss_min = train_loss
-                torch.save(self.model.gnn.state_dict(),
-                           "./pre_trained_gnn/{}.{}.{}.pth".format(dataname, self.pretext, self.gnn_type))
+                # saved as ./pre_trained_gnn/{dataname}.{pretext}.{gnn_type}.pth and indexed with its dims
+                CheckpointRegistry('./pre_trained_gnn/').save(self.model.gnn.state_dict(), dataname, self.pretext,
+                                                              self.gnn_type, **self.dims)
                 # do not use '../pre_trained_gnn/' because hope there should be two folders: (1) '../pre_trained_gnn/'  and (2) './pre_trained_gnn/'
                 # only selected pre-trained models will be moved into (1) so that we can keep reproduction
                 print("+++model saved ! {}.{}.{}.pth".format(dataname, self.pretext, self.gnn_type))
@@ -158,8 +357,12 @@ class PreTrain(torch.nn.Module):
 
 
 if __name__ == '__main__':
+    # the package uses relative imports, run this from the repository root as: python -m ProG.pre_train
+    # (or torchrun --nproc_per_node=N -m ProG.pre_train)
 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # data-parallel over the cpu cores when launched by torchrun, a single process otherwise
+    rank, world_size = init_distributed()
+    device = torch.device('cuda' if torch.cuda.is_available() and world_size == 1 else 'cpu')
     print(device)
    
 
@@ -174,4 +377,6 @@ if __name__ == '__main__':
 
     pt = PreTrain(pretext, gnn_type, input_dim, hid_dim, gln=2)
     pt.model.to(device) 
+    # pt.memory_report(graph_list, batch_size=10)
+    # pt.loader_benchmark(graph_list, batch_size=10)
     pt.train(dataname, graph_list, batch_size=10, aug1='dropN', aug2="permE", aug_ratio=None,lr=0.01, decay=0.0001,epochs=100)
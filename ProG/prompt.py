@@ -1,15 +1,191 @@
 import torch
 import torch.nn.functional as F
 from torch_geometric.data import Batch, Data
-from .utils import act
+from torch_geometric.nn import global_add_pool, global_mean_pool, global_max_pool
+from torch_geometric.utils import add_remaining_self_loops, scatter
+from .utils import act, center_heads, TorchKMeans, fp32_region
+from .compile import CompiledGNN
 import warnings
 from deprecated.sphinx import deprecated
-from sklearn.cluster import KMeans
 # from .Model.model import GNN
 from torch_geometric.nn.inits import glorot
+from torch.utils.checkpoint import checkpoint
+
+
+def rank_in_group(score, group):
+    """
+    :return: rank of each entry (0 is the highest score) among the entries of the same group. ties keep input order.
+    """
+    order = torch.sort(score, descending=True, stable=True)[1]
+    order = order[torch.sort(group[order], stable=True)[1]]
+    _, counts = torch.unique_consecutive(group[order], return_counts=True)
+    starts = torch.cumsum(counts, dim=0) - counts
+    rank = torch.empty_like(order)
+    rank[order] = torch.arange(order.numel(), device=order.device) - starts.repeat_interleave(counts)
+    return rank
+
+
+def prune_links(score, topk_group=None, topk=None, budget_group=None, budget=None):
+    """
+    :return: mask of the links that survive keeping the topk highest scores per topk_group,
+             and then at most budget links per budget_group.
+    """
+    keep = torch.ones_like(score, dtype=torch.bool)
+    if topk is not None:
+        keep = rank_in_group(score, topk_group) < topk
+    if budget is not None:
+        kept = keep.nonzero().view(-1)
+        over = rank_in_group(score[kept], budget_group[kept]) >= budget
+        keep[kept[over]] = False
+    return keep
+
+
+@fp32_region
+def sparse_links(src_x, dst_x, prune, topk=None, topk_by='src', budget=None, dst_batch=None, chunk_size=4096):
+    """
+    links src-->dst with sigmoid(src*dst) >= prune, computed over chunks of dst_x so that the dense
+    [src_num, dst_num] similarity matrix is never allocated.
+    without topk and budget, the links are the same as thresholding the dense matrix.
+
+    :param topk: keep at most topk links per src row in each graph (topk_by='src'), or per dst row (topk_by='dst')
+    :param budget: keep at most budget links per graph, the most similar ones
+    :param dst_batch: graph id of each dst row. every src row is linked to every graph.
+    :return: (src index, dst index), ordered by graph, then src, then dst.
+    """
+    if topk_by not in ['src', 'dst']:
+        raise ValueError("topk_by should be src or dst but you set {}".format(topk_by))
+
+    src_num, dst_num = src_x.shape[0], dst_x.shape[0]
+    if dst_batch is None:
+        dst_batch = torch.zeros(dst_num, dtype=torch.long, device=dst_x.device)
+
+    # links of the chunks, concatenated once after the loop (or when they are pruned)
+    rows = [torch.empty(0, dtype=torch.long, device=dst_x.device)]
+    cols = [torch.empty(0, dtype=torch.long, device=dst_x.device)]
+    vals = [torch.empty(0, dtype=src_x.dtype, device=dst_x.device)]
+    with torch.no_grad():
+        for start in range(0, dst_num, chunk_size):
+            sim = torch.sigmoid(torch.mm(src_x, torch.transpose(dst_x[start:start + chunk_size], 0, 1)))
+            adj = torch.where(sim < prune, 0, sim)
+            r, c = adj.nonzero().t()
+
+            rows.append(r), cols.append(c + start), vals.append(sim[r, c])
+            if topk is None and budget is None:
+                continue
+
+            # top-k and budget are both decomposable over chunks, so candidates are pruned as we go
+            row, col, val = torch.cat(rows), torch.cat(cols), torch.cat(vals)
+            graph = dst_batch[col]
+            topk_group = graph * src_num + row if topk_by == 'src' else col
+            keep = prune_links(val, topk_group, topk, graph, budget)
+            rows, cols, vals = [row[keep]], [col[keep]], [val[keep]]
+
+    row, col = torch.cat(rows), torch.cat(cols)
+    order = torch.sort((dst_batch[col] * src_num + row) * dst_num + col)[1]
+    return row[order], col[order]
+
+
+@fp32_region
+def group_links(tokens, prune, topk=None, budget=None, chunk_size=4096):
+    """
+    inner links token-->token of every token group at once.
+    :param tokens: [group_num, token_num, token_dim]
+    :param topk: keep at most topk links per token
+    :param budget: keep at most budget links per group
+    :return: (group index, src token index, dst token index), ordered by group, then src, then dst.
+    """
+    group_num, token_num, _ = tokens.shape
+
+    # links of the chunks, concatenated once after the loop (or when they are pruned)
+    groups = [torch.empty(0, dtype=torch.long, device=tokens.device)]
+    rows = [torch.empty(0, dtype=torch.long, device=tokens.device)]
+    cols = [torch.empty(0, dtype=torch.long, device=tokens.device)]
+    vals = [torch.empty(0, dtype=tokens.dtype, device=tokens.device)]
+    with torch.no_grad():
+        for start in range(0, token_num, chunk_size):
+            sim = torch.sigmoid(torch.bmm(tokens, torch.transpose(tokens[:, start:start + chunk_size], 1, 2)))
+            adj = torch.where(sim < prune, 0, sim)
+            g, r, c = adj.nonzero().t()
+
+            groups.append(g), rows.append(r), cols.append(c + start), vals.append(sim[g, r, c])
+            if topk is None and budget is None:
+                continue
+
+            group, row, col, val = torch.cat(groups), torch.cat(rows), torch.cat(cols), torch.cat(vals)
+            keep = prune_links(val, group * token_num + row, topk, group, budget)
+            groups, rows, cols, vals = [group[keep]], [row[keep]], [col[keep]], [val[keep]]
+
+    group, row, col = torch.cat(groups), torch.cat(rows), torch.cat(cols)
+    order = torch.sort((group * token_num + row) * token_num + col)[1]
+    return group[order], row[order], col[order]
+
+
+def fused_gcn_layer(conv, h_tok, h_node, inner_adj, cross_adj, edge_index):
+    """
+    one GCNConv over a prompted batch, given as the shared tokens h_tok, the input nodes h_node, the dense
+    token-->token and token-->node adjacency and the edge_index of the input graphs.
+    tokens have no incoming links from nodes, so they are the same in every prompted graph and computed once.
+    """
+    num_nodes = h_node.shape[0]
+    x_tok, x_node = conv.lin(h_tok), conv.lin(h_node)
+
+    weight = torch.ones(edge_index.shape[1], dtype=x_node.dtype, device=x_node.device)
+    if conv.normalize:
+        if conv.add_self_loops:
+            fill_value = 2. if conv.improved else 1.
+            # like add_remaining_self_loops: existing self loops keep their weight
+            inner_adj = inner_adj + torch.diag((inner_adj.diagonal() == 0).to(inner_adj.dtype) * fill_value)
+            edge_index, weight = add_remaining_self_loops(edge_index, weight, fill_value, num_nodes)
+        deg_tok = inner_adj.sum(dim=0)
+        deg_node = scatter(weight, edge_index[1], dim=0, dim_size=num_nodes, reduce='sum') + cross_adj.sum(dim=0)
+        dis_tok = deg_tok.pow(-0.5).masked_fill(deg_tok == 0, 0.)
+        dis_node = deg_node.pow(-0.5).masked_fill(deg_node == 0, 0.)
+    else:
+        dis_tok = x_tok.new_ones(x_tok.shape[0])
+        dis_node = x_node.new_ones(num_nodes)
+
+    x_tok_scaled = dis_tok.view(-1, 1) * x_tok
+    out_tok = dis_tok.view(-1, 1) * torch.mm(inner_adj.t(), x_tok_scaled)
+
+    row, col = edge_index
+    msg = (weight * dis_node[row]).view(-1, 1) * x_node[row]
+    out_node = scatter(msg, col, dim=0, dim_size=num_nodes, reduce='sum') + torch.mm(cross_adj.t(), x_tok_scaled)
+    out_node = dis_node.view(-1, 1) * out_node
+
+    if conv.bias is not None:
+        out_tok, out_node = out_tok + conv.bias, out_node + conv.bias
+    return out_tok, out_node
+
+
+def fused_sage_layer(conv, h_tok, h_node, inner_adj, cross_adj, edge_index):
+    """
+    one SAGEConv (sum or mean aggregation) over a prompted batch, see fused_gcn_layer.
+    """
+    if conv.aggr not in ['mean', 'sum', 'add'] or getattr(conv, 'project', False):
+        raise ValueError("fused SAGEConv only supports mean/sum aggregation without projection")
+    num_nodes = h_node.shape[0]
+    row, col = edge_index
+
+    agg_tok = torch.mm(inner_adj.t(), h_tok)
+    agg_node = scatter(h_node[row], col, dim=0, dim_size=num_nodes, reduce='sum') + torch.mm(cross_adj.t(), h_tok)
+    if conv.aggr == 'mean':
+        cnt_tok = inner_adj.sum(dim=0)
+        cnt_node = scatter(torch.ones_like(row, dtype=h_node.dtype), col, dim=0, dim_size=num_nodes,
+                           reduce='sum') + cross_adj.sum(dim=0)
+        agg_tok = agg_tok / cnt_tok.clamp(min=1).view(-1, 1)
+        agg_node = agg_node / cnt_node.clamp(min=1).view(-1, 1)
+
+    out_tok, out_node = conv.lin_l(agg_tok), conv.lin_l(agg_node)
+    if conv.root_weight:
+        out_tok, out_node = out_tok + conv.lin_r(h_tok), out_node + conv.lin_r(h_node)
+    if conv.normalize:
+        out_tok, out_node = F.normalize(out_tok, p=2., dim=-1), F.normalize(out_node, p=2., dim=-1)
+    return out_tok, out_node
+
 
 class LightPrompt(torch.nn.Module):
-    def __init__(self, token_dim, token_num_per_group, group_num=1, inner_prune=None):
+    def __init__(self, token_dim, token_num_per_group, group_num=1, inner_prune=None,
+                 sparse=False, inner_topk=None, inner_budget=None, chunk_size=4096):
         """
         :param token_dim:
         :param token_num_per_group:
@@ -20,79 +196,231 @@ class LightPrompt(torch.nn.Module):
         :param prune_thre: if inner_prune is None, then all inner and cross prune will adopt this prune_thre
         :param isolate_tokens: if Trure, then inner tokens have no connection.
         :param inner_prune: if inner_prune is not None, then cross prune adopt prune_thre whereas inner prune adopt inner_prune
+        :param sparse: if True, links are built chunk by chunk (see sparse_links) instead of from a dense similarity
+                       matrix. it is turned on implicitly when a topk or budget is given.
+        :param inner_topk: keep at most inner_topk inner links per token
+        :param inner_budget: keep at most inner_budget inner links per prompt graph
+        :param chunk_size: number of columns of the similarity matrix computed at once in sparse mode
         """
         super(LightPrompt, self).__init__()
 
         self.inner_prune = inner_prune
+        self.sparse = sparse
+        self.inner_topk = inner_topk
+        self.inner_budget = inner_budget
+        self.chunk_size = chunk_size
 
-        self.token_list = torch.nn.ParameterList(
-            [torch.nn.Parameter(torch.empty(token_num_per_group, token_dim)) for i in range(group_num)])
+        # all groups are stacked so that the inner links of every group come from one bmm
+        self.tokens = torch.nn.Parameter(torch.empty(group_num, token_num_per_group, token_dim))
 
         self.token_init(init_method="kaiming_uniform")
+        self.clear_structure_cache()
 
     def token_init(self, init_method="kaiming_uniform"):
         if init_method == "kaiming_uniform":
-            for token in self.token_list:
+            # init group by group, so that fan_in is token_dim as it was for one [token_num, token_dim] group
+            for token in self.tokens.data:
                 torch.nn.init.kaiming_uniform_(token, nonlinearity='leaky_relu', mode='fan_in', a=0.01)
         else:
             raise ValueError("only support kaiming_uniform init, more init methods will be included soon")
 
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        # checkpoints saved before the groups were stacked hold one 'token_list.i' entry per group
+        old_prefix = prefix + 'token_list.'
+        old_keys = sorted([k for k in state_dict if k.startswith(old_prefix)], key=lambda k: int(k[len(old_prefix):]))
+        if old_keys:
+            state_dict[prefix + 'tokens'] = torch.stack([state_dict.pop(k) for k in old_keys])
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                      missing_keys, unexpected_keys, error_msgs)
+
     def inner_structure_update(self):
         return self.token_view()
 
+    def structure_key(self):
+        """
+        the inner structure only depends on the token values and the pruning settings. optimizer steps and
+        load_state_dict update the tokens in place, which bumps their version counter.
+        """
+        return (self.tokens.data_ptr(), self.tokens._version,
+                self.inner_prune, self.sparse, self.inner_topk, self.inner_budget)
+
+    def clear_structure_cache(self):
+        self._structure = None
+        self._structure_key = None
+
     def token_view(self, ):
         """
         each token group is viewed as a prompt sub-graph.
         turn the all groups of tokens as a batch of prompt graphs.
+
+        the structure (edge_index, batch, ptr, y) is cached and only rebuilt after the tokens change.
+        x is the tokens themselves, taken fresh on every call so that autograd sees the current parameters.
         :return:
         """
-        pg_list = []
-        for i, tokens in enumerate(self.token_list):
-            # inner link: token-->token
-            token_dot = torch.mm(tokens, torch.transpose(tokens, 0, 1))
-            token_sim = torch.sigmoid(token_dot)  # 0-1
+        key = self.structure_key()
+        if self._structure_key != key:
+            self._structure = self.build_structure()
+            self._structure_key = key
 
-            inner_adj = torch.where(token_sim < self.inner_prune, 0, token_sim)
-            edge_index = inner_adj.nonzero().t().contiguous()
+        edge_index, y, batch, ptr = self._structure
+        x = self.tokens.view(-1, self.tokens.shape[-1])
+        return Batch(x=x, edge_index=edge_index, y=y, batch=batch, ptr=ptr)
 
-            pg_list.append(Data(x=tokens, edge_index=edge_index, y=torch.tensor([i]).long()))
+    def build_structure(self):
+        """
+        group i holds tokens [i*token_num, (i+1)*token_num) of the prompt batch and has label i.
+        :return: edge_index, y, batch, ptr of the prompt batch
+        """
+        group_num, token_num, _ = self.tokens.shape
+        device = self.tokens.device
+
+        sparse = self.sparse or self.inner_topk is not None or self.inner_budget is not None
+        chunk_size = self.chunk_size if sparse else token_num
 
-        pg_batch = Batch.from_data_list(pg_list)
-        return pg_batch
+        # inner link: token-->token
+        g, r, c = group_links(self.tokens, self.inner_prune, topk=self.inner_topk, budget=self.inner_budget,
+                              chunk_size=chunk_size)
+        edge_index = torch.stack([g * token_num + r, g * token_num + c])
+
+        y = torch.arange(group_num, device=device)
+        batch = y.repeat_interleave(token_num)
+        ptr = torch.arange(group_num + 1, device=device) * token_num
+        return edge_index, y, batch, ptr
 
 class HeavyPrompt(LightPrompt):
-    def __init__(self, token_dim, token_num, cross_prune=0.1, inner_prune=0.01):
-        super(HeavyPrompt, self).__init__(token_dim, token_num, 1, inner_prune)  # only has one prompt graph.
+    def __init__(self, token_dim, token_num, cross_prune=0.1, inner_prune=0.01, batched=True,
+                 sparse=False, cross_topk=None, topk_by='token', cross_budget=None, inner_topk=None,
+                 inner_budget=None, chunk_size=4096, ann=None):
+        """
+        :param batched: if True, cross links of the whole graph batch are computed in one pass and the prompted
+                        batch is assembled with node offsets. if False, graphs are prompted one by one.
+                        Both modes return the same prompted batch.
+        :param cross_topk: keep at most cross_topk cross links per token (topk_by='token') or per node (topk_by='node')
+        :param cross_budget: keep at most cross_budget cross links per input graph
+        :param ann: an approximate nearest neighbor index over the tokens (e.g. ann.TokenIVFIndex). if given,
+                    only the token-node pairs it returns are candidates for cross links.
+        the other params are the same as LightPrompt.
+        """
+        super(HeavyPrompt, self).__init__(token_dim, token_num, 1, inner_prune, sparse=sparse, inner_topk=inner_topk,
+                                          inner_budget=inner_budget, chunk_size=chunk_size)  # only has one prompt graph.
+        if topk_by not in ['token', 'node']:
+            raise ValueError("topk_by should be token or node but you set {}".format(topk_by))
         self.cross_prune = cross_prune
+        self.batched = batched
+        self.cross_topk = cross_topk
+        self.topk_by = topk_by
+        self.cross_budget = cross_budget
+        self.ann = ann
+
+    @fp32_region
+    def cross_links(self, pg_x, g_x, g_batch=None):
+        """
+        cross link: token-->node
+        :param g_batch: graph id of each node, the cross budget is counted per graph
+        :return: (token index, node index) of the kept links, ordered by token then node within each graph.
+        """
+        if self.ann is not None:
+            return self.ann_cross_links(pg_x, g_x, g_batch)
+
+        if self.sparse or self.cross_topk is not None or self.cross_budget is not None:
+            return sparse_links(pg_x, g_x, self.cross_prune, topk=self.cross_topk,
+                                topk_by='src' if self.topk_by == 'token' else 'dst', budget=self.cross_budget,
+                                dst_batch=g_batch, chunk_size=self.chunk_size)
+
+        cross_dot = torch.mm(pg_x, torch.transpose(g_x, 0, 1))
+        cross_sim = torch.sigmoid(cross_dot)  # 0-1 from prompt to input graph
+        cross_adj = torch.where(cross_sim < self.cross_prune, 0, cross_sim)
+        token_idx, node_idx = cross_adj.nonzero().t()
+        return token_idx, node_idx
+
+    def ann_cross_links(self, pg_x, g_x, g_batch=None):
+        token_num, num_nodes = pg_x.shape[0], g_x.shape[0]
+        if g_batch is None:
+            g_batch = torch.zeros(num_nodes, dtype=torch.long, device=g_x.device)
+
+        token_idx, node_idx, sim = self.ann.search(pg_x, g_x, self.cross_prune)
+        if self.cross_topk is not None or self.cross_budget is not None:
+            graph = g_batch[node_idx]
+            topk_group = graph * token_num + token_idx if self.topk_by == 'token' else node_idx
+            keep = prune_links(sim, topk_group, self.cross_topk, graph, self.cross_budget)
+            token_idx, node_idx = token_idx[keep], node_idx[keep]
+
+        order = torch.sort((g_batch[node_idx] * token_num + token_idx) * num_nodes + node_idx)[1]
+        return token_idx[order], node_idx[order]
+
+    def ann_recall(self, graph_batch: Batch):
+        """
+        :return: recall of the ann cross links against the exact ones on graph_batch
+        """
+        pg = self.inner_structure_update()
+        return self.ann.recall(pg.x, graph_batch.x, self.cross_prune)
+
+    def fused_gnn(self, graph_batch: Batch, gnn):
+        """
+        graph embeddings of gnn over the prompted graph_batch, without materializing the prompted batch.
+        for GCN and GraphSage layers, token-->node messages are dense matmuls with the cross adjacency and only
+        the edges of the input graphs go through sparse scatter. tokens only receive messages from tokens,
+        so they are computed once instead of once per graph.
+        the result is the same as gnn(prompted.x, prompted.edge_index, prompted.batch) when dropout is inactive.
+        other gnn types fall back to the materialized prompted batch.
+        """
+        if gnn.gnn_type not in ['GCN', 'GraphSage'] or gnn.JK != 'last':
+            prompted_graph = self(graph_batch)
+            return gnn(prompted_graph.x, prompted_graph.edge_index, prompted_graph.batch)
+
+        pg = self.inner_structure_update()
+        token_num, num_nodes = pg.x.shape[0], graph_batch.x.shape[0]
+        num_graphs = graph_batch.num_graphs
+        node_batch = graph_batch.batch
+
+        inner_adj = pg.x.new_zeros(token_num, token_num)
+        inner_adj[pg.edge_index[0], pg.edge_index[1]] = 1.
+        token_idx, node_idx = self.cross_links(pg.x, graph_batch.x, node_batch)
+        cross_adj = pg.x.new_zeros(token_num, num_nodes)
+        cross_adj[token_idx, node_idx] = 1.
+
+        layer = fused_gcn_layer if gnn.gnn_type == 'GCN' else fused_sage_layer
+        h_tok, h_node = pg.x, graph_batch.x
+        for idx, conv in enumerate(gnn.conv_layers):
+            h_tok, h_node = layer(conv, h_tok, h_node, inner_adj, cross_adj, graph_batch.edge_index)
+            if idx != len(gnn.conv_layers) - 1:
+                h_tok, h_node = act(h_tok), act(h_node)
+                h_tok = F.dropout(h_tok, gnn.drop_ratio, training=gnn.training)
+                h_node = F.dropout(h_node, gnn.drop_ratio, training=gnn.training)
+
+        # every graph is pooled over its own nodes plus the token_num shared tokens
+        if gnn.pool is global_max_pool:
+            return torch.maximum(global_max_pool(h_node, node_batch, size=num_graphs), h_tok.max(dim=0)[0])
+        graph_emb = global_add_pool(h_node, node_batch, size=num_graphs) + h_tok.sum(dim=0)
+        if gnn.pool is global_mean_pool:
+            sizes = torch.bincount(node_batch, minlength=num_graphs) + token_num
+            graph_emb = graph_emb / sizes.view(-1, 1).to(graph_emb.dtype)
+        return graph_emb
 
     def forward(self, graph_batch: Batch):
         """
-        TODO: although it recieves graph batch, currently we only implement one-by-one computing instead of batch computing
-        TODO: we will implement batch computing once we figure out the memory sharing mechanism within PyG
         :param graph_batch:
-        :return:
+        :return: batch of prompted graphs, each of which is [prompt tokens, nodes of one input graph].
         """
-        # device = torch.device("cuda")
-        # device = torch.device("cpu")
-
         pg = self.inner_structure_update()  # batch of prompt graph (currently only 1 prompt graph in the batch)
 
+        if self.batched:
+            return self.forward_batched(pg, graph_batch)
+        else:
+            return self.forward_per_graph(pg, graph_batch)
+
+    def forward_per_graph(self, pg, graph_batch: Batch):
         inner_edge_index = pg.edge_index
         token_num = pg.x.shape[0]
 
         re_graph_list = []
         for g in Batch.to_data_list(graph_batch):
             g_edge_index = g.edge_index + token_num
-            # pg_x = pg.x.to(device)
-            # g_x = g.x.to(device)
-            
-            cross_dot = torch.mm(pg.x, torch.transpose(g.x, 0, 1))
-            cross_sim = torch.sigmoid(cross_dot)  # 0-1 from prompt to input graph
-            cross_adj = torch.where(cross_sim < self.cross_prune, 0, cross_sim)
-            
-            cross_edge_index = cross_adj.nonzero().t().contiguous()
-            cross_edge_index[1] = cross_edge_index[1] + token_num
-            
+
+            token_idx, node_idx = self.cross_links(pg.x, g.x)
+            cross_edge_index = torch.stack([token_idx, node_idx + token_num])
+
             x = torch.cat([pg.x, g.x], dim=0)
             y = g.y
 
@@ -103,15 +431,77 @@ class HeavyPrompt(LightPrompt):
         graphp_batch = Batch.from_data_list(re_graph_list)
         return graphp_batch
 
+    def forward_batched(self, pg, graph_batch: Batch):
+        """
+        same result as forward_per_graph, but without unbatching graph_batch:
+        graph i is laid out as [tokens, nodes of graph i], so its nodes are shifted by (i+1)*token_num
+        and its tokens start at ptr[i].
+        """
+        inner_edge_index = pg.edge_index
+        token_num = pg.x.shape[0]
+        device = graph_batch.x.device
+
+        num_graphs = graph_batch.num_graphs
+        num_nodes = graph_batch.x.shape[0]
+        node_batch = graph_batch.batch
+        graph_ids = torch.arange(num_graphs, device=device)
+        token_ids = torch.arange(token_num, device=device)
+        node_ids = torch.arange(num_nodes, device=device)
+
+        sizes = torch.bincount(node_batch, minlength=num_graphs) + token_num
+        ptr = torch.cat([sizes.new_zeros(1), torch.cumsum(sizes, dim=0)])
+        node_shift = (node_batch + 1) * token_num
+        batch = graph_ids.repeat_interleave(sizes)
+
+        # gather x from [tokens, all nodes of graph_batch] so that gradients still flow into the tokens
+        src = torch.empty(ptr[-1].item(), dtype=torch.long, device=device)
+        src[(ptr[:-1].view(-1, 1) + token_ids.view(1, -1)).view(-1)] = token_ids.repeat(num_graphs)
+        src[node_ids + node_shift] = node_ids + token_num
+        x = torch.cat([pg.x, graph_batch.x], dim=0)[src]
+
+        inner_edges = (inner_edge_index.unsqueeze(1) + ptr[:-1].view(1, -1, 1)).view(2, -1)
+        inner_graph = graph_ids.repeat_interleave(inner_edge_index.shape[1])
+
+        g_edges = graph_batch.edge_index + node_shift[graph_batch.edge_index[0]]
+        g_graph = node_batch[graph_batch.edge_index[0]]
+
+        token_idx, node_idx = self.cross_links(pg.x, graph_batch.x, node_batch)
+        cross_graph = node_batch[node_idx]
+        cross_edges = torch.stack([token_idx + ptr[cross_graph], node_idx + node_shift[node_idx]])
+
+        # per graph: inner edges, then graph edges, then cross edges (the order Batch.from_data_list produces)
+        edge_index = torch.cat([inner_edges, g_edges, cross_edges], dim=1)
+        segment = torch.cat([inner_graph * 3, g_graph * 3 + 1, cross_graph * 3 + 2])
+        _, order = torch.sort(segment, stable=True)
+        edge_index = edge_index[:, order]
+
+        graphp_batch = Batch(x=x, edge_index=edge_index, y=graph_batch.y, batch=batch, ptr=ptr)
+        return graphp_batch
+
 class FrontAndHead(torch.nn.Module):
     def __init__(self, input_dim, hid_dim=16, num_classes=2,
                  task_type="multi_label_classification",
-                 token_num=10, cross_prune=0.1, inner_prune=0.3):
+                 token_num=10, cross_prune=0.1, inner_prune=0.3, batched=True,
+                 sparse=False, cross_topk=None, topk_by='token', cross_budget=None, chunk_size=4096, fused=False,
+                 compiled=False):
+        """
+        :param sparse, cross_topk, topk_by, cross_budget, chunk_size: sparse cross links of the prompt, see HeavyPrompt
+        :param fused: if True, the gnn runs prompt-aware message passing (see HeavyPrompt.fused_gnn)
+        :param compiled: if True, the gnn runs through a shape-bucketed torch.compile wrapper (see compile.CompiledGNN).
+                         only the gnn is compiled: the prompt (cross links, whose number depends on the data) and
+                         the answering head stay eager.
+        """
 
         super().__init__()
+        self.fused = fused
+        self.compiled = compiled
+        # CompiledGNN per gnn, kept out of the registered submodules so that the gnn weights are not ours
+        self._compiled_gnns = {}
 
         self.PG = HeavyPrompt(token_dim=input_dim, token_num=token_num, cross_prune=cross_prune,
-                              inner_prune=inner_prune)
+                              inner_prune=inner_prune, batched=batched, sparse=sparse,
+                              cross_topk=cross_topk, topk_by=topk_by, cross_budget=cross_budget,
+                              chunk_size=chunk_size)
 
         if task_type == 'multi_label_classification':
             self.answering = torch.nn.Sequential(
@@ -121,62 +511,82 @@ class FrontAndHead(torch.nn.Module):
             raise NotImplementedError
 
     def forward(self, graph_batch, gnn):
-        prompted_graph = self.PG(graph_batch)
-        graph_emb = gnn(prompted_graph.x, prompted_graph.edge_index, prompted_graph.batch)
+        if self.fused:
+            graph_emb = self.PG.fused_gnn(graph_batch, gnn)
+        else:
+            prompted_graph = self.PG(graph_batch)
+            if self.compiled:
+                if id(gnn) not in self._compiled_gnns:
+                    self._compiled_gnns[id(gnn)] = CompiledGNN(gnn)
+                gnn = self._compiled_gnns[id(gnn)]
+                # the graph count comes from ptr, no device sync
+                graph_emb = gnn(prompted_graph.x, prompted_graph.edge_index, prompted_graph.batch,
+                                num_graphs=prompted_graph.num_graphs)
+            else:
+                graph_emb = gnn(prompted_graph.x, prompted_graph.edge_index, prompted_graph.batch)
         pre = self.answering(graph_emb)
 
         return pre
 
 class GPPTPrompt(torch.nn.Module):
-    def __init__(self, n_hidden, center_num, n_classes, dropout):
+    def __init__(self, n_hidden, center_num, n_classes, dropout, prompt_update_every=1, kmeans_batch_size=None):
         super(GPPTPrompt, self).__init__()
         self.center_num = center_num
+        self.n_classes = n_classes
         self.prompt = torch.nn.Linear(n_hidden, center_num, bias=False)
-        self.pp = torch.nn.ModuleList()
-        for i in range(center_num):
-            self.pp.append(torch.nn.Linear(2 * n_hidden, n_classes, bias=False))
+        # one [n_classes, n_hidden] head per center, stacked so that all heads are applied in one matmul
+        self.pp_weight = torch.nn.Parameter(torch.empty(center_num, n_classes, n_hidden))
+        for w in self.pp_weight.data:
+            torch.nn.init.kaiming_uniform_(w, a=5 ** 0.5)
         self.dropout = torch.nn.Dropout(dropout)
-
-    def weigth_init(self,data,feature,label,index):
-        h = self.dropout(feature)
-        edge_index = data.edge_index
-        for l, layer in enumerate(self.layers):
-            h = layer(h,edge_index)
-            if l != len(self.layers) - 1:
-                h = self.activation(h)
-                h = self.dropout(h)
-        h = self.activation(h)
-        data.h=h        
+        self.kmeans = TorchKMeans(center_num, n_init=10, batch_size=kmeans_batch_size, seed=0)
+        self.prompt_update_every = prompt_update_every
+        self.prompt_step = 0
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        # checkpoints saved before the heads were stacked hold one 'pp.i.weight' entry per center
+        old_keys = ['{}pp.{}.weight'.format(prefix, i) for i in range(self.center_num)]
+        if all(k in state_dict for k in old_keys):
+            state_dict[prefix + 'pp_weight'] = torch.stack([state_dict.pop(k) for k in old_keys])
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                      missing_keys, unexpected_keys, error_msgs)
+
+    def weigth_init(self, h, label, index):
+        """
+        :param h: node hidden states from the pre-trained gnn
+        """
         features=h[index]
         labels=label[index.long()]
-        cluster = KMeans(n_clusters=self.center_num,random_state=0).fit(features.detach().cpu())        
-        temp=torch.FloatTensor(cluster.cluster_centers_).cuda()
+        temp=self.kmeans.fit(features)
         self.prompt.weight.data = temp.clone().detach()
         p=[]
         for i in range(self.n_classes):
             p.append(features[labels==i].mean(dim=0).view(1,-1))
         temp=torch.cat(p,dim=0)
-        for i in range(self.center_num):
-            self.pp[i].weight.data = temp.clone().detach()    
+        self.pp_weight.data.copy_(temp.detach().expand_as(self.pp_weight))
 
     def update_prompt_weight(self,h):
-        cluster = KMeans(n_clusters=self.center_num,random_state=0).fit(h.detach().cpu())
-        temp=torch.FloatTensor(cluster.cluster_centers_).cuda()
+        self.prompt_step += 1
+        if self.prompt_step % self.prompt_update_every != 0:
+            return
+        temp=self.kmeans.partial_fit(h, init=self.prompt.weight)
         self.prompt.weight.data= temp.clone().detach()
 
     def get_mul_prompt(self):
-        pros=[]
-        for name,param in self.named_parameters():
-            if name.startswith('pp.'):
-                pros.append(param)
-        return pros
+        # one [n_classes, n_hidden] view per center head
+        return list(self.pp_weight.unbind(0))
         
     def get_prompt(self):
         for name,param in self.named_parameters():
             if name.startswith('prompt.weight'):
                 pro=param
         return pro
-        
+
+    def forward(self, h):
+        index = torch.argmax(self.prompt(h), dim=1)
+        return center_heads(h, self.pp_weight, index)
+
 class GPF(torch.nn.Module):
     def __init__(self, in_channels: int):
         super(GPF, self).__init__()
@@ -189,11 +599,67 @@ class GPF(torch.nn.Module):
     def add(self, x: torch.Tensor):
         return x + self.global_emb
 
+class StreamingPrompt(torch.autograd.Function):
+    """
+    softmax(x weight^T + bias).mm(p_list) over blocks of p_chunk_size prompt bases. forward only saves the output and
+    the running max and normalizer of every row, backward recomputes the softmax block by block, so neither pass
+    holds more than one [N, p_chunk_size] block of scores.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight, bias, p_list, p_chunk_size):
+        m = x.new_full((x.shape[0], 1), float('-inf'))
+        l = x.new_zeros((x.shape[0], 1))
+        out = x.new_zeros((x.shape[0], p_list.shape[1]))
+        for start in range(0, p_list.shape[0], p_chunk_size):
+            end = start + p_chunk_size
+            score = F.linear(x, weight[start:end], bias[start:end])
+            m_new = torch.maximum(m, score.max(dim=1, keepdim=True)[0])
+            scale = torch.exp(m - m_new)
+            e = torch.exp(score - m_new)
+            l = l * scale + e.sum(dim=1, keepdim=True)
+            out = out * scale + e.mm(p_list[start:end])
+            m = m_new
+        out = out / l
+        ctx.save_for_backward(x, weight, bias, p_list, out, m, l)
+        ctx.p_chunk_size = p_chunk_size
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        x, weight, bias, p_list, out, m, l = ctx.saved_tensors
+        # softmax backward: d score = w * (grad_out p^T - sum_p w_p (grad_out p_p)), and the last sum is grad_out . out
+        delta = (grad_out * out).sum(dim=1, keepdim=True)
+        grad_x = torch.zeros_like(x)
+        grad_weight, grad_bias, grad_p = torch.zeros_like(weight), torch.zeros_like(bias), torch.zeros_like(p_list)
+        for start in range(0, p_list.shape[0], ctx.p_chunk_size):
+            end = start + ctx.p_chunk_size
+            w = torch.exp(F.linear(x, weight[start:end], bias[start:end]) - m) / l
+            grad_p[start:end] = w.t().mm(grad_out)
+            d_score = w * (grad_out.mm(p_list[start:end].t()) - delta)
+            grad_weight[start:end] = d_score.t().mm(x)
+            grad_bias[start:end] = d_score.sum(dim=0)
+            grad_x += d_score.mm(weight[start:end])
+        return grad_x, grad_weight, grad_bias, grad_p, None
+
+
 class GPF_plus(torch.nn.Module):
-    def __init__(self, in_channels: int, p_num: int):
+    def __init__(self, in_channels: int, p_num: int, chunk_size=None, p_chunk_size=None, topk=None):
+        """
+        :param chunk_size: if set, node rows are prompted chunk_size at a time and each chunk is recomputed in
+                           backward, so only a [chunk_size, p_num] attention is alive at once.
+                           the result is identical to the dense mode.
+        :param p_chunk_size: if set, prompt bases are streamed p_chunk_size at a time with an online softmax, in
+                             forward and backward, so memory no longer grows with p_num either: only
+                             [chunk_size, p_chunk_size] blocks are alive at once, plus one [N, in_channels] output.
+        :param topk: if set, each node only attends to its topk highest scoring prompt bases.
+        """
         super(GPF_plus, self).__init__()
         self.p_list = torch.nn.Parameter(torch.Tensor(p_num, in_channels))
         self.a = torch.nn.Linear(in_channels, p_num)
+        self.chunk_size = chunk_size
+        self.p_chunk_size = p_chunk_size
+        self.topk = topk
         self.reset_parameters()
 
     def reset_parameters(self):
@@ -201,12 +667,73 @@ class GPF_plus(torch.nn.Module):
         self.a.reset_parameters()
 
     def add(self, x: torch.Tensor):
-        score = self.a(x)
-        # weight = torch.exp(score) / torch.sum(torch.exp(score), dim=1).view(-1, 1)
-        weight = F.softmax(score, dim=1)
-        p = weight.mm(self.p_list)
+        if self.chunk_size is None and self.p_chunk_size is None and self.topk is None:
+            # weight = torch.exp(score) / torch.sum(torch.exp(score), dim=1).view(-1, 1)
+            return x + self.prompt_chunk(x)
+
+        chunk_size = x.shape[0] if self.chunk_size is None else self.chunk_size
+        # the streaming path recomputes its blocks in its own backward, checkpointing it would keep them alive
+        streaming = self.topk is None and self.p_chunk_size is not None
+        p_list = []
+        for start in range(0, x.shape[0], chunk_size):
+            x_chunk = x[start:start + chunk_size]
+            if torch.is_grad_enabled() and not streaming:
+                p_list.append(checkpoint(self.prompt_chunk, x_chunk, use_reentrant=False))
+            else:
+                p_list.append(self.prompt_chunk(x_chunk))
+
+        return x + torch.cat(p_list, dim=0)
+
+    def prompt_chunk(self, x: torch.Tensor):
+        # only the scores and their softmax run in fp32, the weighted sum over p_list follows mixed_precision
+        if self.topk is not None:
+            return self.topk_prompt(x)
+        if self.p_chunk_size is None:
+            return self.attention(x).mm(self.p_list)
+        return self.streaming_prompt(x)
+
+    @fp32_region
+    def attention(self, x: torch.Tensor):
+        return F.softmax(self.a(x), dim=1)
+
+    @fp32_region
+    def score_block(self, x: torch.Tensor, start, end):
+        return F.linear(x, self.a.weight[start:end], self.a.bias[start:end])
+
+    def scores(self, x: torch.Tensor):
+        """
+        yields (first prompt base index, scores of x over p_chunk_size prompt bases)
+        """
+        p_num = self.p_list.shape[0]
+        p_chunk_size = p_num if self.p_chunk_size is None else self.p_chunk_size
+        for start in range(0, p_num, p_chunk_size):
+            end = start + p_chunk_size
+            yield start, self.score_block(x, start, end)
+
+    @fp32_region
+    def streaming_prompt(self, x: torch.Tensor):
+        """
+        softmax(a(x)).mm(p_list), one block of prompt bases at a time with a running max and normalizer, in forward
+        and in backward (see StreamingPrompt). the running statistics need fp32, so this path stays in fp32.
+        """
+        return StreamingPrompt.apply(x, self.a.weight, self.a.bias, self.p_list, self.p_chunk_size)
 
-        return x + p
+    def topk_prompt(self, x: torch.Tensor):
+        """
+        softmax over the topk scores of each node only, the other prompt bases get zero weight.
+        """
+        top_score, top_index = None, None
+        for start, score in self.scores(x):
+            s, i = score.topk(min(self.topk, score.shape[1]), dim=1)
+            i = i + start
+            if top_score is not None:
+                s, i = torch.cat([top_score, s], dim=1), torch.cat([top_index, i], dim=1)
+                s, j = s.topk(min(self.topk, s.shape[1]), dim=1)
+                i = i.gather(1, j)
+            top_score, top_index = s, i
+
+        weight = F.softmax(top_score, dim=1)
+        return torch.einsum('nk,nkd->nd', weight, self.p_list[top_index])
 
 # class GPrompt(torch.nn.modules):
 #     def __init__(self):
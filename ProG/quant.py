@@ -0,0 +1,170 @@
+import os
+import copy
+import glob
+import time
+import pickle as pk
+
+import torch
+from torch import nn
+from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig
+from torch_geometric.data import Batch
+from torch_geometric.nn.dense.linear import Linear as PyGLinear
+
+from .registry import load_checkpoint
+
+
+class GNNWithHead(nn.Module):
+    def __init__(self, gnn, answering=None):
+        """
+        a GNN followed by an optional answering head, quantized and served as one module
+        """
+        super().__init__()
+        self.gnn = gnn
+        self.answering = answering
+
+    def forward(self, x, edge_index, batch):
+        emb = self.gnn(x, edge_index, batch)
+        return emb if self.answering is None else self.answering(emb)
+
+
+def swap_pyg_linears(module):
+    """
+    replaces (in place) the torch_geometric Linear layers used inside GCNConv, GATConv, TransformerConv and SAGEConv
+    by torch.nn.Linear with the same weights, so that quantize_dynamic recognizes them.
+    """
+    for name, child in module.named_children():
+        if isinstance(child, PyGLinear):
+            lin = nn.Linear(child.in_channels, child.out_channels, bias=child.bias is not None)
+            lin.weight.data.copy_(child.weight.data)
+            if child.bias is not None:
+                lin.bias.data.copy_(child.bias.data)
+            setattr(module, name, lin)
+        else:
+            swap_pyg_linears(child)
+    return module
+
+
+def linear_layers(model):
+    """
+    names of the layers quantize can turn into int8
+    """
+    swapped = swap_pyg_linears(copy.deepcopy(model))
+    return [name for name, m in swapped.named_modules() if isinstance(m, nn.Linear)]
+
+
+def quantize(model, layers=None):
+    """
+    :param layers: names of the linear layers to quantize (see linear_layers), None for all of them
+    :return: a cpu copy of model with dynamic int8 linear layers, model itself is not changed
+    """
+    qmodel = swap_pyg_linears(copy.deepcopy(model)).cpu().eval()
+    qconfig_spec = {nn.Linear} if layers is None else {name: default_dynamic_qconfig for name in layers}
+    return quantize_dynamic(qmodel, qconfig_spec, dtype=torch.qint8)
+
+
+def load_induced_graphs(dataname, limit=None):
+    """
+    induced graphs stored by Data.data_preprocess under ./dataset/{dataname}/induced_graphs/
+    """
+    graphs = []
+    for fname in sorted(glob.glob('./dataset/{}/induced_graphs/task*'.format(dataname))):
+        with open(fname, 'br') as f:
+            graphs += pk.load(f)['pos']
+        if limit is not None and len(graphs) >= limit:
+            break
+    return graphs if limit is None else graphs[:limit]
+
+
+def graph_batches(graphs, batch_size):
+    return [Batch.from_data_list(graphs[i:i + batch_size]) for i in range(0, len(graphs), batch_size)]
+
+
+def relative_error(ref, out):
+    num = sum(((r - o) ** 2).sum() for r, o in zip(ref, out))
+    den = sum((r ** 2).sum() for r in ref)
+    return (num / torch.as_tensor(den).clamp(min=1e-12)).sqrt().item()
+
+
+@torch.no_grad()
+def calibrate(model, graphs, tol=0.05, batch_size=64):
+    """
+    dynamic int8 needs no activation ranges, so calibration selects the layers instead: every linear layer is
+    quantized alone and the relative error of the model output on the calibration graphs is measured.
+    layers with an error above tol stay in fp32.
+    :return: names of the layers to quantize, {layer name: relative error}
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    batches = graph_batches(graphs, batch_size)
+    ref = [model(b.x, b.edge_index, b.batch) for b in batches]
+
+    errors = {}
+    for name in linear_layers(model):
+        qmodel = quantize(model, [name])
+        errors[name] = relative_error(ref, [qmodel(b.x, b.edge_index, b.batch) for b in batches])
+        print("{} | relative error: {:.4f}".format(name, errors[name]))
+    return [name for name, e in errors.items() if e <= tol], errors
+
+
+@torch.no_grad()
+def compare(model, qmodel, graphs, batch_size=64, repeat=3):
+    """
+    latency (best of repeat runs) and accuracy of the int8 model against the fp32 one on graphs.
+    prediction agreement and accuracy are only reported for models with an answering head.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    batches = graph_batches(graphs, batch_size)
+
+    def run(m):
+        best, outs = float('inf'), None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            outs = [m(b.x, b.edge_index, b.batch) for b in batches]
+            best = min(best, time.perf_counter() - start)
+        return best, outs
+
+    fp32_time, fp32_out = run(model)
+    int8_time, int8_out = run(qmodel)
+    report = {'fp32_ms_per_graph': fp32_time * 1000 / len(graphs),
+              'int8_ms_per_graph': int8_time * 1000 / len(graphs),
+              'speedup': fp32_time / int8_time,
+              'relative_error': relative_error(fp32_out, int8_out)}
+
+    if getattr(model, 'answering', None) is not None:
+        fp32_pred, int8_pred = torch.cat(fp32_out).argmax(dim=1), torch.cat(int8_out).argmax(dim=1)
+        report['agreement'] = (fp32_pred == int8_pred).float().mean().item()
+        if all(getattr(g, 'y', None) is not None for g in graphs):
+            y = torch.cat([b.y for b in batches])
+            report['fp32_acc'] = (fp32_pred == y).float().mean().item()
+            report['int8_acc'] = (int8_pred == y).float().mean().item()
+
+    for key, value in report.items():
+        print("{}: {:.4f}".format(key, value))
+    return report
+
+
+def quantize_pretrained(gnn, path, graphs, answering=None, tol=0.05, batch_size=64):
+    """
+    post-training int8 flow for a checkpoint written by PreTrain.train: loads path into gnn, selects the layers
+    on the calibration graphs, quantizes gnn (and answering) and compares it with the fp32 model.
+    :return: int8 model, report
+    """
+    gnn.load_state_dict(load_checkpoint(path))
+    model = GNNWithHead(gnn, answering).cpu().eval()
+    layers, errors = calibrate(model, graphs, tol, batch_size)
+    qmodel = quantize(model, layers)
+    report = compare(model, qmodel, graphs, batch_size)
+    report['layers'] = layers
+    report['layer_errors'] = errors
+    return qmodel, report
+
+
+if __name__ == '__main__':
+    from .Model.model import GNN
+
+    dataname, pretext, gnn_type = 'CiteSeer', 'GraphCL', 'GCN'
+    graphs = load_induced_graphs(dataname, limit=512)
+    input_dim = graphs[0].x.shape[1]
+    # PreTrain uses hid_dim = input_dim
+    gnn = GNN(input_dim=input_dim, hid_dim=input_dim, out_dim=input_dim, num_layer=2, gnn_type=gnn_type)
+    path = os.path.join('./pre_trained_gnn/', '{}.{}.{}.pth'.format(dataname, pretext, gnn_type))
+    quantize_pretrained(gnn, path, graphs)
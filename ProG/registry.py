@@ -0,0 +1,123 @@
+import os
+import re
+import json
+import pickle
+import zipfile
+
+import torch
+
+
+def plain_load(path):
+    # full unpickling, the checkpoints of the registry are written by PreTrain.train
+    try:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:
+        return torch.load(path, map_location='cpu')
+
+
+def load_checkpoint(path):
+    """
+    state dict of path, memory-mapped: tensors are backed by the file pages instead of being read into private
+    memory, so every process of the host loading the same checkpoint shares one physical copy of the weights
+    (writes stay private, copy-on-write). falls back to a plain load on torch versions without mmap, for legacy
+    (non zip) checkpoints, which cannot be memory-mapped, and for checkpoints holding other objects than tensors.
+    """
+    if not zipfile.is_zipfile(path):
+        return plain_load(path)
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except (TypeError, RuntimeError, pickle.UnpicklingError):
+        return plain_load(path)
+
+
+def load_into(model, state_dict, strict=True):
+    """
+    load_state_dict without copying: the parameters of model become the (memory-mapped) tensors of state_dict.
+    falls back to copying on torch versions without assign, and when model does not live on the cpu.
+    """
+    param = next(model.parameters(), None)
+    if param is not None and param.device.type != 'cpu':
+        return model.load_state_dict(state_dict, strict=strict)
+    try:
+        return model.load_state_dict(state_dict, strict=strict, assign=True)
+    except TypeError:
+        return model.load_state_dict(state_dict, strict=strict)
+
+
+def gnn_dims(state_dict):
+    """
+    input_dim, hid_dim and num_layer of a GNN state dict, read from the weights of its first conv layer
+    """
+    layers = set(int(m.group(1)) for m in (re.match(r'conv_layers\.(\d+)\.', k) for k in state_dict) if m)
+    for key, value in state_dict.items():
+        if key.startswith('conv_layers.0.') and key.endswith('weight') and value.dim() == 2:
+            return {'input_dim': value.shape[1], 'hid_dim': value.shape[0], 'num_layer': len(layers)}
+    return {}
+
+
+class CheckpointRegistry:
+    def __init__(self, root='./pre_trained_gnn/', index_file='index.json'):
+        """
+        index of the pre-trained GNN checkpoints of root, by dataset, pretext, gnn_type and dims
+        (input_dim, hid_dim, num_layer). the index is a json file in root; checkpoints saved before the registry
+        existed ({dataset}.{pretext}.{gnn_type}.pth) are picked up by scan().
+        """
+        self.root = root
+        self.index_path = os.path.join(root, index_file)
+        self.entries = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.entries = json.load(f)
+
+    def write_index(self):
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.index_path, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+
+    def register(self, path, dataset, pretext, gnn_type, **dims):
+        entry = dict(path=os.path.relpath(path, self.root), dataset=dataset, pretext=pretext, gnn_type=gnn_type, **dims)
+        self.entries = [e for e in self.entries if e['path'] != entry['path']] + [entry]
+        self.write_index()
+        return entry
+
+    def save(self, state_dict, dataset, pretext, gnn_type, **dims):
+        """
+        saves state_dict as {dataset}.{pretext}.{gnn_type}.pth in root and indexes it with dims
+        """
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, '{}.{}.{}.pth'.format(dataset, pretext, gnn_type))
+        torch.save(state_dict, path)
+        return self.register(path, dataset, pretext, gnn_type, **dims)
+
+    def scan(self):
+        """
+        indexes the checkpoints of root named {dataset}.{pretext}.{gnn_type}.pth that are not indexed yet,
+        their dims are read from the weights
+        """
+        known = set(e['path'] for e in self.entries)
+        for fname in sorted(os.listdir(self.root)):
+            parts = fname.split('.')
+            if fname in known or len(parts) != 4 or parts[-1] != 'pth':
+                continue
+            dims = gnn_dims(load_checkpoint(os.path.join(self.root, fname)))
+            self.entries.append(dict(path=fname, dataset=parts[0], pretext=parts[1], gnn_type=parts[2], **dims))
+        self.write_index()
+        return self.entries
+
+    def find(self, **query):
+        """
+        entries matching all given fields, e.g. find(dataset='CiteSeer', gnn_type='GCN', hid_dim=100)
+        """
+        return [e for e in self.entries if all(e.get(k) == v for k, v in query.items())]
+
+    def path(self, **query):
+        found = self.find(**query)
+        if len(found) != 1:
+            raise KeyError("{} checkpoints match {}, expected 1".format(len(found), query))
+        return os.path.join(self.root, found[0]['path'])
+
+    def load(self, model, strict=True, **query):
+        """
+        loads the only checkpoint matching query into model, memory-mapped and without copy (see load_checkpoint)
+        """
+        return load_into(model, load_checkpoint(self.path(**query)), strict=strict)
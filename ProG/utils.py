@@ -1,19 +1,25 @@
 import os
+import hashlib
+import functools
+import contextlib
 import numpy as np
 import random
 import torch
-from copy import deepcopy
 from random import shuffle
 from torch_geometric.data import Data
 from torch_geometric.utils import subgraph, k_hop_subgraph
 import pickle as pk
 from torch_geometric.utils import to_undirected
+from torch_geometric.nn.conv.gcn_conv import gcn_norm
 from torch_geometric.loader.cluster import ClusterData
 from torch import nn, optim
+from torch.func import functional_call
 from torch_geometric.datasets import Planetoid
 import torch.nn.functional as F
-from torch_geometric.loader import NeighborSampler
+from torch_geometric.loader import NeighborSampler, NeighborLoader
 from sklearn.metrics import accuracy_score
+from . import augment
+from .distributed import all_reduce_tensors, broadcast_tensors
 seed = 0
 
 
@@ -36,16 +42,21 @@ def mkdir(path):
 
 
 # used in pre_train.py
+@torch.no_grad()
 def gen_ran_output(data, model):
-    vice_model = deepcopy(model)
-
-    for (vice_name, vice_model_param), (name, param) in zip(vice_model.named_parameters(), model.named_parameters()):
-        if vice_name.split('.')[0] == 'projection_head':
-            vice_model_param.data = param.data
-        else:
-            vice_model_param.data = param.data + 0.1 * torch.normal(0, torch.ones_like(
-                param.data) * param.data.std())
-    z2 = vice_model.forward_cl(data.x, data.edge_index, data.batch)
+    """
+    SimGRACE view: model.forward_cl with gaussian noise of std 0.1 * std(param) added to every parameter outside the
+    projection head. the noised parameters are passed to functional_call, model is neither copied nor changed.
+    """
+    names, params = zip(*[(name, param.detach()) for name, param in model.named_parameters()
+                          if name.split('.')[0] != 'projection_head'])
+    numels = [param.numel() for param in params]
+    flat = torch.cat([param.reshape(-1) for param in params])
+    std = torch.stack([param.std() for param in params])
+    # one noise draw for all parameters, scaled by the std of the parameter each entry belongs to
+    flat = flat + torch.randn_like(flat) * (0.1 * std).repeat_interleave(torch.tensor(numels, device=flat.device))
+    noised = {name: t.view_as(param) for name, t, param in zip(names, flat.split(numels), params)}
+    z2 = functional_call(model, noised, (data.x, data.edge_index, data.batch))
 
     return z2
 
@@ -80,6 +91,306 @@ def act(x=None, act_type='leakyrelu'):
             return torch.tanh(x)
         
 
+
+# data keys of the normalized adjacency, per gnn_type
+ADJ_KEYS = {'GCN': 'gcn_adj', 'GraphSage': 'mean_adj'}
+
+
+def normalized_adj(edge_index, num_nodes, gnn_type='GCN'):
+    """
+    message passing matrix of a GCN layer (symmetric normalization with self loops, as gcn_norm) or of a mean
+    GraphSage layer, as (index, weight) sorted by target node, i.e. in CSR order.
+    only layers with these default settings can use it, see adj_matches_conv.
+    """
+    if gnn_type == 'GCN':
+        index, weight = gcn_norm(edge_index, None, num_nodes, add_self_loops=True)
+    elif gnn_type == 'GraphSage':
+        index = edge_index
+        deg = torch.bincount(index[1], minlength=num_nodes).float()
+        weight = 1. / deg[index[1]]
+    else:
+        raise KeyError('normalized adjacency is only defined for GCN and GraphSage but got {}'.format(gnn_type))
+    order = torch.sort(index[1], stable=True)[1]
+    return index[:, order], weight[order]
+
+
+def adj_matches_conv(conv, gnn_type):
+    """
+    True if normalized_adj(gnn_type) is the message passing of conv: a GCNConv with normalize, add_self_loops and
+    not improved, or a SAGEConv with mean aggregation and without project.
+    """
+    if gnn_type == 'GCN':
+        return conv.normalize and conv.add_self_loops and not conv.improved
+    if gnn_type == 'GraphSage':
+        return conv.aggr == 'mean' and not getattr(conv, 'project', False)
+    return False
+
+
+def graph_signature(data):
+    """
+    num_nodes, num_edges and sha1 of the edge_index of data, to tell whether a persisted adjacency belongs to it
+    """
+    edge_index = data.edge_index.detach().cpu().contiguous()
+    return data.num_nodes, edge_index.shape[1], hashlib.sha1(edge_index.numpy().tobytes()).hexdigest()
+
+
+def attach_normalized_adj(data, gnn_type='GCN'):
+    """
+    stores the normalized adjacency of gnn_type on data as <key>_index / <key>_weight, so that it is saved and
+    batched with the graph (the index is shifted by PyG like edge_index), and the signature of the graph it was
+    computed for as <key>_signature (see check_normalized_adj).
+    """
+    key = ADJ_KEYS[gnn_type]
+    data[key + '_index'], data[key + '_weight'] = normalized_adj(data.edge_index, data.num_nodes, gnn_type)
+    data[key + '_signature'] = '{}.{}.{}'.format(*graph_signature(data))
+    return data
+
+
+def check_normalized_adj(data_list, gnn_type='GCN'):
+    """
+    graphs stored with their adjacency (attach_normalized_adj) keep it only if it was computed for the same nodes
+    and edges, the adjacency of the other graphs (changed, or stored without it) is computed again.
+    """
+    key = ADJ_KEYS[gnn_type]
+    for data in data_list:
+        signature = data[key + '_signature'] if key + '_signature' in data else None
+        if signature != '{}.{}.{}'.format(*graph_signature(data)):
+            attach_normalized_adj(data, gnn_type)
+    return data_list
+
+
+def load_normalized_adj(data_list, path, gnn_type='GCN'):
+    """
+    attaches the normalized adjacency of gnn_type to every graph of data_list. it is computed once and
+    persisted in path together with the signature of every graph (graph_signature), later runs only load it.
+    the adjacency of a graph whose signature changed (other dataset, split or preprocessing) is recomputed.
+    """
+    saved = torch.load(path) if os.path.exists(path) else None
+    if not isinstance(saved, dict) or saved.get('gnn_type') != gnn_type:
+        saved = {'gnn_type': gnn_type, 'signatures': [], 'adjs': []}
+    known = dict(zip(saved['signatures'], saved['adjs']))
+
+    signatures = [graph_signature(d) for d in data_list]
+    adjs = [known[sig] if sig in known else normalized_adj(d.edge_index, d.num_nodes, gnn_type)
+            for d, sig in zip(data_list, signatures)]
+    if signatures != saved['signatures']:
+        torch.save({'gnn_type': gnn_type, 'signatures': signatures, 'adjs': adjs}, path)
+    key = ADJ_KEYS[gnn_type]
+    for d, (index, weight) in zip(data_list, adjs):
+        d[key + '_index'], d[key + '_weight'] = index, weight
+    return data_list
+
+
+def csr_adj(data, gnn_type='GCN'):
+    """
+    torch sparse CSR matrix (rows are target nodes) of the normalized adjacency stored on data or on a batch of
+    such graphs, None if data has none.
+    """
+    key = ADJ_KEYS.get(gnn_type)
+    if key is None or key + '_index' not in data:
+        return None
+    index, weight = data[key + '_index'], data[key + '_weight']
+    num_nodes = data.num_nodes
+    crow = torch.cat([index.new_zeros(1), torch.cumsum(torch.bincount(index[1], minlength=num_nodes), 0)])
+    return torch.sparse_csr_tensor(crow, index[0], weight, (num_nodes, num_nodes))
+
+
+def mixed_precision(enabled=True, device_type='cpu', dtype=torch.bfloat16):
+    """
+    autocast region for the forward pass: matmuls and convolutions run in bfloat16 while the weights stay fp32
+    (master weights), so the optimizer keeps updating fp32 parameters. bfloat16 has the exponent range of fp32,
+    so no loss scaling is needed. backward goes outside of the region.
+    """
+    return torch.autocast(device_type=device_type, dtype=dtype, enabled=enabled)
+
+
+def fp32_region(fn):
+    """
+    decorator: fn runs with autocast disabled and its floating point tensor arguments cast to fp32.
+    used for the numerically sensitive parts under mixed_precision (contrastive loss, prompt similarities).
+    """
+    def cast(a):
+        return a.float() if torch.is_tensor(a) and a.is_floating_point() else a
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        cpu_on, cuda_on = torch.is_autocast_cpu_enabled(), torch.is_autocast_enabled()
+        if not (cpu_on or cuda_on):
+            return fn(*args, **kwargs)
+        args = [cast(a) for a in args]
+        kwargs = {k: cast(v) for k, v in kwargs.items()}
+        with contextlib.ExitStack() as stack:
+            if cpu_on:
+                stack.enter_context(torch.autocast(device_type='cpu', enabled=False))
+            if cuda_on:
+                stack.enter_context(torch.autocast(device_type='cuda', enabled=False))
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def activation_memory(fn, exclude=()):
+    """
+    memory of one training step: runs loss = fn() and loss.backward().
+    :param exclude: tensors not counted as activations, e.g. the model parameters
+    :return: {'saved_mb': size of the tensors autograd keeps for backward, each storage counted once,
+              'peak_cuda_mb': peak cuda memory of forward + backward, 0 on cpu}
+    """
+    skip = set(t.untyped_storage().data_ptr() for t in exclude)
+    saved = {}
+
+    def pack(t):
+        storage = t.untyped_storage()
+        if storage.data_ptr() not in skip:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return t
+
+    on_cuda = torch.cuda.is_available()
+    if on_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        start = torch.cuda.memory_allocated()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        loss = fn()
+    loss.float().sum().backward()
+    peak = torch.cuda.max_memory_allocated() - start if on_cuda else 0
+    return {'saved_mb': sum(saved.values()) / 2 ** 20, 'peak_cuda_mb': peak / 2 ** 20}
+
+
+# used in Model/model.py and prompt.py
+def center_heads(h, pp_weight, index):
+    """
+    applies head pp_weight[index[n]] to row n of h.
+    :param h: [num_nodes, n_hidden]
+    :param pp_weight: [center_num, n_classes, n_hidden]
+    :param index: [num_nodes], center of each node
+    :return: [num_nodes, n_classes]
+    """
+    center_num = pp_weight.shape[0]
+    # nodes sorted by center: every head only scores its own nodes, so neither the work nor the memory has a
+    # num_nodes x center_num x n_classes term
+    order = torch.argsort(index)
+    counts = torch.bincount(index, minlength=center_num).tolist()
+    out = torch.cat([torch.mm(h[rows], pp_weight[c].t()) for c, rows in enumerate(order.split(counts))])
+    inverse = torch.empty_like(order)
+    inverse[order] = torch.arange(order.shape[0], device=order.device)
+    return out[inverse]
+
+
+# used in Model/model.py and prompt.py
+class TorchKMeans:
+    def __init__(self, n_clusters, n_init=10, max_iter=300, tol=1e-4, batch_size=None, n_iter=1, seed=0,
+                 distributed=False):
+        """
+        k-means in torch, on the device of the data, so GPPT never copies hidden states to the host.
+        fit() is k-means++ plus Lloyd iterations (best of n_init, like sklearn KMeans).
+        partial_fit() warm-starts from the current centers and runs n_iter mini-batch k-means steps.
+        with distributed=True every worker ends with the same centers under data parallelism (see distributed.py):
+        fit() takes those of rank 0 and partial_fit() sums the per-center sums and counts of all workers before
+        updating. these are collectives, so every rank has to call fit / partial_fit at the same steps.
+
+        :param batch_size: rows sampled per partial_fit step, None means all rows
+        :param distributed: synchronize the centers over the workers, see above
+        """
+        self.n_clusters = n_clusters
+        self.n_init = n_init
+        self.max_iter = max_iter
+        self.tol = tol
+        self.batch_size = batch_size
+        self.n_iter = n_iter
+        self.seed = seed
+        self.distributed = distributed
+        self.generator = None
+        self.centers = None
+        self.counts = None
+
+    def _generator(self, device):
+        if self.generator is None or self.generator.device != device:
+            self.generator = torch.Generator(device=device)
+            self.generator.manual_seed(self.seed)
+        return self.generator
+
+    def _init_centers(self, x):
+        # k-means++
+        g = self._generator(x.device)
+        centers = x.new_empty(self.n_clusters, x.shape[1])
+        centers[0] = x[torch.randint(x.shape[0], (1,), generator=g, device=x.device)].view(-1)
+        d2 = ((x - centers[0]) ** 2).sum(dim=1)
+        for i in range(1, self.n_clusters):
+            if d2.sum() > 0:
+                idx = torch.multinomial(d2, 1, generator=g)
+            else:
+                idx = torch.randint(x.shape[0], (1,), generator=g, device=x.device)
+            centers[i] = x[idx].view(-1)
+            d2 = torch.minimum(d2, ((x - centers[i]) ** 2).sum(dim=1))
+        return centers
+
+    def _assign(self, x, centers):
+        dist = torch.cdist(x, centers)
+        d, labels = dist.min(dim=1)
+        return labels, d
+
+    def _lloyd(self, x, centers):
+        tol = self.tol * x.var(dim=0).mean()
+        for _ in range(self.max_iter):
+            labels, _ = self._assign(x, centers)
+            counts = torch.bincount(labels, minlength=self.n_clusters)
+            sums = torch.zeros_like(centers).index_add_(0, labels, x)
+            new_centers = torch.where((counts > 0).view(-1, 1), sums / counts.clamp(min=1).view(-1, 1), centers)
+            shift = ((new_centers - centers) ** 2).sum()
+            centers = new_centers
+            if shift <= tol:
+                break
+        labels, d = self._assign(x, centers)
+        return centers, torch.bincount(labels, minlength=self.n_clusters), (d ** 2).sum()
+
+    def fit(self, x):
+        with torch.no_grad():
+            x = x.detach()
+            best = None
+            for _ in range(self.n_init):
+                centers, counts, inertia = self._lloyd(x, self._init_centers(x))
+                if best is None or inertia < best[2]:
+                    best = (centers, counts, inertia)
+            self.centers, self.counts = best[0], best[1].to(x.dtype)
+            if self.distributed:
+                broadcast_tensors(self.centers, self.counts)
+        return self.centers
+
+    def partial_fit(self, x, init=None):
+        """
+        :param init: centers to start from instead of the current ones, e.g. the prompt weights. the per-center
+                     counts restart from zero, so the first step moves every center to the mean of its rows
+                     (a Lloyd step) and the centers keep tracking drifting features instead of freezing as 1/t.
+        """
+        with torch.no_grad():
+            x = x.detach()
+            if init is not None:
+                self.centers = init.detach().to(x.device, x.dtype).clone()
+                self.counts = None
+            if self.centers is None:
+                return self.fit(x)
+            if self.counts is None or self.counts.device != x.device:
+                self.counts = torch.zeros(self.n_clusters, dtype=x.dtype, device=x.device)
+
+            g = self._generator(x.device)
+            for _ in range(self.n_iter):
+                batch = x
+                if self.batch_size is not None and self.batch_size < x.shape[0]:
+                    batch = x[torch.randperm(x.shape[0], generator=g, device=x.device)[:self.batch_size]]
+                labels, _ = self._assign(batch, self.centers)
+                batch_counts = torch.bincount(labels, minlength=self.n_clusters).to(x.dtype)
+                batch_sums = torch.zeros_like(self.centers).index_add_(0, labels, batch)
+                if self.distributed:
+                    all_reduce_tensors(batch_counts, batch_sums)
+                # per-center learning rate 1/count, as in mini-batch k-means
+                self.counts += batch_counts
+                lr = (batch_counts / self.counts.clamp(min=1)).view(-1, 1)
+                batch_means = batch_sums / batch_counts.clamp(min=1).view(-1, 1)
+                self.centers = self.centers + lr * (batch_means - self.centers)
+        return self.centers
+
+
 def GPPT_load_data(dataset):
     if dataset in ['Cora', 'CiteSeer']:
         dataset = Planetoid(root='/tmp/'+dataset, name=dataset)
@@ -152,7 +463,26 @@ def evaluate(model, data, nid, batch_size, device,sample_list):
         labels = np.concatenate(labels)
         accuracy = accuracy_score(labels, predictions)
     return accuracy
-    
+
+
+def neighbor_loader(data, input_nodes, sample_list, batch_size, shuffle=False, num_workers=0, prefetch_factor=2):
+    """
+    mini-batches of sampled neighborhoods for node tasks. every batch is a subgraph of data whose first
+    batch.batch_size nodes are the seed nodes taken from input_nodes, so a model runs on (batch.x, batch.edge_index)
+    and its first batch.batch_size outputs are the predictions of the seeds.
+
+    :param data: the full graph, kept on cpu so that the workers can sample from it
+    :param sample_list: neighbors sampled per layer, e.g. [4, 4] for a 2-layer GNN
+    :param num_workers: sampling processes; they stay alive across epochs and each prefetches prefetch_factor
+                        batches in the background
+    """
+    kwargs = {}
+    if num_workers > 0:
+        kwargs.update(persistent_workers=True, prefetch_factor=prefetch_factor)
+    return NeighborLoader(data, num_neighbors=list(sample_list), input_nodes=input_nodes, batch_size=batch_size,
+                          shuffle=shuffle, num_workers=num_workers, pin_memory=torch.cuda.is_available(), **kwargs)
+
+
 def seed_torch(seed=1029):
 	random.seed(seed)
 	os.environ['PYTHONHASHSEED'] = str(seed) # 为了禁止hash随机化，使得实验可复现
@@ -251,75 +581,24 @@ def __induced_graph_list_for_graphs__(seeds_list, label, p, num_nodes, potential
     return induced_graph_list
 
 
+# the augmentations live in augment.py, they return new graphs and never change data
 def graph_views(data, aug='random', aug_ratio=0.1):
-    if aug == 'dropN':
-        data = drop_nodes(data, aug_ratio)
-
-    elif aug == 'permE':
-        data = permute_edges(data, aug_ratio)
-    elif aug == 'maskN':
-        data = mask_nodes(data, aug_ratio)
-    elif aug == 'random':
-        n = np.random.randint(2)
-        if n == 0:
-            data = drop_nodes(data, aug_ratio)
-        elif n == 1:
-            data = permute_edges(data, aug_ratio)
-        else:
-            print('augmentation error')
-            assert False
-    return data
+    return augment.graph_views(data, aug, aug_ratio)
 
 
 def drop_nodes(data, aug_ratio):
-    node_num, _ = data.x.size()
-    _, edge_num = data.edge_index.size()
-    drop_num = int(node_num * aug_ratio)
-
-    idx_perm = np.random.permutation(node_num)
-
-    idx_drop = idx_perm[:drop_num]
-    idx_nondrop = idx_perm[drop_num:]
-    idx_nondrop.sort()
-    idx_dict = {idx_nondrop[n]: n for n in list(range(idx_nondrop.shape[0]))}
-
-    edge_index = data.edge_index.numpy()
-
-    edge_index = [[idx_dict[edge_index[0, n]], idx_dict[edge_index[1, n]]] for n in range(edge_num) if
-                  (not edge_index[0, n] in idx_drop) and (not edge_index[1, n] in idx_drop)]
-    try:
-        data.edge_index = torch.tensor(edge_index).transpose_(0, 1)
-        data.x = data.x[idx_nondrop]
-    except:
-        data = data
-
-    return data
+    return augment.drop_nodes(data, aug_ratio)
 
 
 def permute_edges(data, aug_ratio):
     """
     only change edge_index, all the other keys unchanged and consistent
     """
-    node_num, _ = data.x.size()
-    _, edge_num = data.edge_index.size()
-    permute_num = int(edge_num * aug_ratio)
-    edge_index = data.edge_index.numpy()
-
-    idx_delete = np.random.choice(edge_num, (edge_num - permute_num), replace=False)
-    data.edge_index = data.edge_index[:, idx_delete]
-
-    return data
+    return augment.permute_edges(data, aug_ratio)
 
 
 def mask_nodes(data, aug_ratio):
-    node_num, feat_dim = data.x.size()
-    mask_num = int(node_num * aug_ratio)
-
-    token = data.x.mean(dim=0)
-    idx_mask = np.random.choice(node_num, mask_num, replace=False)
-    data.x[idx_mask] = token.clone().detach()
-
-    return data
+    return augment.mask_nodes(data, aug_ratio)
 
 
 def GPPT_load_data(dataset):
@@ -1,13 +1,17 @@
+import argparse
 import torch
 import torchmetrics
 from torch_geometric.loader import DataLoader
 from ProG.Model.model import GNN
 from ProG.prompt import GPF,GPF_plus,LightPrompt
+from ProG.cache import GraphEmbeddingCache
+from ProG.utils import load_normalized_adj, csr_adj, mixed_precision
+from ProG.distributed import init_distributed, shard, broadcast_parameters, all_reduce_gradients, is_main_process
 from torch import nn, optim
 from ProG.Data.data import load_graph_task
 
 
-def prompt_train(PG, train_loader, model, opi_pg, device, epoch, prompt_epoch):
+def prompt_train(PG, train_loader, model, opi_pg, device, epoch, prompt_epoch, emb_cache=None):
     
     # training stage
     PG.train()
@@ -15,32 +19,41 @@ def prompt_train(PG, train_loader, model, opi_pg, device, epoch, prompt_epoch):
     for batch_id, train_batch in enumerate(train_loader):
         # print(train_batch)
         train_batch = train_batch.to(device)
-        emb0 = model(train_batch.x, train_batch.edge_index, train_batch.batch)
-        pg_batch = PG.inner_structure_update()
-        pg_batch = pg_batch.to (device)
-        pg_emb = model(pg_batch.x, pg_batch.edge_index, pg_batch.batch)
-        # cross link between prompt and input graphs
-        dot = torch.mm(emb0, torch.transpose(pg_emb, 0, 1))
-        
-        sim = torch.softmax(dot, dim=1)
-
-        train_loss = criterion(sim, train_batch.y)
+        with mixed_precision(amp, device_type=device.type):
+            if emb_cache is not None:
+                emb0 = emb_cache.embed(model, train_batch)
+            else:
+                emb0 = model(train_batch.x, train_batch.edge_index, train_batch.batch)
+            pg_batch = PG.inner_structure_update()
+            pg_batch = pg_batch.to (device)
+            pg_emb = model(pg_batch.x, pg_batch.edge_index, pg_batch.batch)
+            # cross link between prompt and input graphs
+            dot = torch.mm(emb0, torch.transpose(pg_emb, 0, 1))
+
+            sim = torch.softmax(dot.float(), dim=1)
+
+            train_loss = criterion(sim, train_batch.y)
         opi_pg.zero_grad()
         train_loss.backward()
+        all_reduce_gradients(PG)
         opi_pg.step()
         print('epoch {}/{} | batch {}/{} | loss: {:.8f}'.format(epoch, prompt_epoch, batch_id+1, len(train_loader), train_loss))
 
-def acc_f1_over_batches(test_loader, PG, model, num_class, device):
+def acc_f1_over_batches(test_loader, PG, model, num_class, device, emb_cache=None):
     accuracy = torchmetrics.classification.Accuracy(task="multiclass", num_classes=num_class).to(device)
     macro_f1 = torchmetrics.classification.F1Score(task="multiclass", num_classes=num_class, average="macro").to(device)
     for batch_id, test_batch in enumerate(test_loader):
         test_batch = test_batch.to(device)
-        emb0 = model(test_batch.x, test_batch.edge_index, test_batch.batch)
-        pg_batch = PG.token_view()
-        pg_batch = pg_batch.to(device)
-        pg_emb = model(pg_batch.x, pg_batch.edge_index, pg_batch.batch)
-        dot = torch.mm(emb0, torch.transpose(pg_emb, 0, 1))
-        pre = torch.softmax(dot, dim=1)
+        with mixed_precision(amp, device_type=device.type):
+            if emb_cache is not None:
+                emb0 = emb_cache.embed(model, test_batch)
+            else:
+                emb0 = model(test_batch.x, test_batch.edge_index, test_batch.batch)
+            pg_batch = PG.token_view()
+            pg_batch = pg_batch.to(device)
+            pg_emb = model(pg_batch.x, pg_batch.edge_index, pg_batch.batch)
+            dot = torch.mm(emb0, torch.transpose(pg_emb, 0, 1))
+        pre = torch.softmax(dot.float(), dim=1)
 
         y = test_batch.y
         pre_cla = torch.argmax(pre, dim=1)
@@ -61,9 +74,11 @@ def train(model,train_loader,prompt,device):
     model.train()
     for data in train_loader:  # Iterate in batches over the training dataset.
          data = data.to(device)
-         out = model(data.x, data.edge_index, data.batch, prompt = prompt)  # Perform a single forward pass.
-         loss = criterion(out, data.y)  # Compute the loss.
+         with mixed_precision(amp, device_type=device.type):
+             out = model(data.x, data.edge_index, data.batch, prompt = prompt, adj = csr_adj(data, model.gnn_type))  # Perform a single forward pass.
+             loss = criterion(out.float(), data.y)  # Compute the loss.
          loss.backward()  # Derive gradients.
+         all_reduce_gradients(model)  # Average them over the workers (no-op in a single process).
          optimizer.step()  # Update parameters based on gradients.
          optimizer.zero_grad()  # Clear gradients.
 
@@ -73,7 +88,8 @@ def test(model,loader, prompt, device):
     correct = 0
     for data in loader: 
         data = data.to(device) # Iterate in batches over the training/test dataset.
-        out = model(data.x, data.edge_index, data.batch, prompt = prompt)  
+        with mixed_precision(amp, device_type=device.type):
+            out = model(data.x, data.edge_index, data.batch, prompt = prompt, adj = csr_adj(data, model.gnn_type))  
         pred = out.argmax(dim=1)  # Use the class with highest probability.
         correct += int((pred == data.y).sum())  # Check against ground-truth labels.
     return correct / len(loader.dataset)  # Derive ratio of correct predictions.
@@ -81,18 +97,33 @@ def test(model,loader, prompt, device):
 
 
 
+parser = argparse.ArgumentParser(description='graph classification with prompts')
+# bfloat16 forward passes (see utils.mixed_precision), the prompt similarities stay in fp32
+parser.add_argument('--amp', action='store_true', help="mixed precision forward passes")
+args, _ = parser.parse_known_args()
+amp = args.amp
+
+# data-parallel when launched by torchrun (each worker trains on its shard of the training graphs)
+rank, world_size = init_distributed()
+
 dataset_name = 'MUTAG'
 dataset, train_dataset, test_dataset = load_graph_task(dataset_name)
+gnn_type = 'GraphSage'
+# every graph is reused in all epochs: its normalized adjacency is computed once and persisted next to the dataset
+adj_path = 'data/TUDataset/{}/normalized_adj.{}.{}.pt'
+train_dataset = load_normalized_adj(list(train_dataset), adj_path.format(dataset_name, gnn_type, 'train'), gnn_type)
+test_dataset = load_normalized_adj(list(test_dataset), adj_path.format(dataset_name, gnn_type, 'test'), gnn_type)
 
 
-train_loader = DataLoader(train_dataset, batch_size=64, shuffle=True)
+train_loader = DataLoader(shard(train_dataset), batch_size=64, shuffle=True)
 test_loader = DataLoader(test_dataset, batch_size=64, shuffle=False)
 # Number of graphs in the current batch: 64
 # Batch(edge_attr=[2560, 4], edge_index=[2, 2560], x=[1154, 7], y=[64], batch=[1154], ptr=[65])
 print("prepare data is finished!")
 
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-model = GNN(input_dim=dataset.num_features,out_dim=dataset.num_classes, gnn_type='GraphSage').to(device)
+device = torch.device('cuda' if torch.cuda.is_available() and world_size == 1 else 'cpu')
+model = GNN(input_dim=dataset.num_features,out_dim=dataset.num_classes, gnn_type=gnn_type).to(device)
+broadcast_parameters(model)
 optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
 criterion = torch.nn.CrossEntropyLoss()
 
@@ -107,19 +138,25 @@ elif prompt_type =='ProG':
     for p in model.parameters():
         p.requires_grad = False
     opi = optim.Adam(filter(lambda p: p.requires_grad, prompt.parameters()),lr=lr, weight_decay=wd)
+    # the gnn is frozen, so graph embeddings are computed once and reused by every prompt epoch
+    emb_cache = GraphEmbeddingCache()
+    # the graph keys are hashed once here instead of in every batch of every epoch
+    GraphEmbeddingCache.tag_graphs(train_dataset + test_dataset)
 elif prompt_type == 'gpf':
     prompt = GPF(dataset.num_features).to(device)
 elif prompt_type == 'gpf-plus':
     prompt = GPF_plus(dataset.num_features,dataset.num_nodes).to(device)
 else:
     raise KeyError(" We don't support this kind of prompt.")
+if prompt_type is not None:
+    broadcast_parameters(prompt)
 
 
 if prompt_type == 'ProG':
     prompt_epoch = 200
     for j in range(1, prompt_epoch + 1):
-        prompt_train(prompt, train_loader, model, opi, device, epoch = j, prompt_epoch = prompt_epoch)
-        acc_f1_over_batches(test_loader, prompt, model, dataset.num_classes, device)
+        prompt_train(prompt, train_loader, model, opi, device, epoch = j, prompt_epoch = prompt_epoch, emb_cache = emb_cache)
+        acc_f1_over_batches(test_loader, prompt, model, dataset.num_classes, device, emb_cache = emb_cache)
 
 else:
     epoch=100
@@ -127,7 +164,8 @@ else:
         train(model, train_loader, prompt = prompt, device = device)
         train_acc = test(model, train_loader, prompt = prompt, device = device)
         test_acc = test(model, test_loader, prompt = prompt, device = device)
-        print(f'Epoch: {i:03d}, Train Acc: {train_acc:.4f}, Test Acc: {test_acc:.4f}') 
+        if is_main_process():
+            print(f'Epoch: {i:03d}, Train Acc: {train_acc:.4f}, Test Acc: {test_acc:.4f}') 
         
 
         
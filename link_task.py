@@ -83,5 +83,8 @@ for epoch in range(1, 101):
 
 print(f'Final Test: {final_test_auc:.4f}')
 
-z = model(test_data.x, test_data.edge_index)
-final_edge_index = model.decode_all(z)
\ No newline at end of file
+model.eval()
+with torch.no_grad():
+    z = model(test_data.x, test_data.edge_index)
+# new links only: training edges are excluded and every node keeps its 10 best candidates
+final_edge_index = model.decode_topk(z, k=10, exclude_edge_index=train_data.edge_index)
\ No newline at end of file
@@ -1,15 +1,36 @@
 
 from ProG.Model.model import GNN, GPPT
+from ProG.get_args import get_my_args
 import torch
 from ProG.prompt import GPF,GPF_plus
 from ProG.Data.data import load_node_task
-from ProG.utils import constraint
+from ProG.utils import constraint, neighbor_loader, load_normalized_adj, csr_adj, mixed_precision
+from ProG.distributed import init_distributed, shard, broadcast_parameters, all_reduce_gradients, is_main_process
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 dataset_name ='Cora'
 data, dataset = load_node_task(dataset_name)
-data = data.to(device)
 data.train_id = torch.nonzero(data.train_mask).squeeze(1)
+
+# mini-batch training on sampled neighborhoods instead of one full-graph forward (--mini-batch),
+# fanouts (--sample-list), batch size and sampling workers come from get_args.py
+args = get_my_args()
+mini_batch = args.mini_batch
+amp = args.amp
+if mini_batch:
+      # data-parallel when launched by torchrun: every worker samples around its shard of the training nodes
+      rank, world_size = init_distributed()
+      if world_size > 1:
+            device = torch.device('cpu')
+      train_loader = neighbor_loader(data, shard(data.train_id), args.sample_list, args.batch_size, shuffle=True,
+                                     num_workers=args.num_workers)
+      val_loader = neighbor_loader(data, data.val_mask, args.sample_list, args.batch_size, num_workers=args.num_workers)
+      test_loader = neighbor_loader(data, data.test_mask, args.sample_list, args.batch_size, num_workers=args.num_workers)
+else:
+      # the graph is static over all epochs: normalize it once (and persist it) instead of in every GCNConv call
+      load_normalized_adj([data], 'data/Planetoid/{}/normalized_adj.gcn.pt'.format(dataset_name), 'GCN')
+      data = data.to(device)
+      adj = csr_adj(data, 'GCN')
 model = GNN(input_dim=dataset.num_features,out_dim=dataset.num_classes, gnn_type='GCN').to(device)
 
 # setting prompt
@@ -20,10 +41,18 @@ elif prompt_type == 'gpf-plus':
       prompt = GPF_plus(data.num_features,data.num_nodes ).to(device)
 elif prompt_type == 'gppt':
       model = GPPT(in_feats = dataset.num_features, n_classes= dataset.num_classes).to(device)
-      model.weigth_init(data.x,data.edge_index,data.y,data.train_id)
+      if mini_batch:
+            # one sampled subgraph around all training nodes is enough to initialize the centers
+            init_loader = neighbor_loader(data, data.train_id, args.sample_list, data.train_id.numel())
+            init_batch = next(iter(init_loader)).to(device)
+            model.weigth_init(init_batch.x, init_batch.edge_index, init_batch.y,
+                              torch.arange(init_batch.batch_size, device=device))
+      else:
+            model.weigth_init(data.x,data.edge_index,data.y,data.train_id)
 else:
       prompt = None
 
+broadcast_parameters(model)
 optimizer = torch.optim.Adam(model.parameters(), lr=0.005, weight_decay=5e-4)
 criterion = torch.nn.CrossEntropyLoss()
 
@@ -33,16 +62,18 @@ def train(model, data):
       if prompt_type != 'gppt':
             model.train()
             optimizer.zero_grad() 
-            out = model(data.x, data.edge_index, batch=None, prompt = prompt) 
-            loss = criterion(out[data.train_mask], data.y[data.train_mask])  
+            with mixed_precision(amp, device_type=device.type):
+                  out = model(data.x, data.edge_index, batch=None, prompt = prompt, adj = adj) 
+                  loss = criterion(out[data.train_mask].float(), data.y[data.train_mask])  
             loss.backward()  
             optimizer.step()  
             return loss
       else:
             model.train()
-            out = model(data.x, data.edge_index)
-            loss = criterion(out[data.train_mask], data.y[data.train_mask])
-            loss = loss + 0.001 * constraint(device,model.get_mul_prompt())
+            with mixed_precision(amp, device_type=device.type):
+                  out = model(data.x, data.edge_index)
+                  loss = criterion(out[data.train_mask].float(), data.y[data.train_mask])
+                  loss = loss + 0.001 * constraint(device,model.get_mul_prompt())
             optimizer.zero_grad()
             loss.backward()
             optimizer.step()
@@ -51,12 +82,55 @@ def train(model, data):
 
       
 
+def train_mini_batch(model, loader):
+      model.train()
+      total_loss, total_num = 0., 0
+      for batch in loader:
+            batch = batch.to(device, non_blocking=True)
+            y = batch.y[:batch.batch_size]
+            with mixed_precision(amp, device_type=device.type):
+                  if prompt_type != 'gppt':
+                        out = model(batch.x, batch.edge_index, batch=None, prompt = prompt)[:batch.batch_size]
+                        loss = criterion(out.float(), y)
+                  else:
+                        out = model(batch.x, batch.edge_index)[:batch.batch_size]
+                        loss = criterion(out.float(), y)
+                        loss = loss + 0.001 * constraint(device,model.get_mul_prompt())
+            optimizer.zero_grad()
+            loss.backward()
+            all_reduce_gradients(model)
+            optimizer.step()
+            if prompt_type == 'gppt':
+                  model.update_prompt_weight(model.get_mid_h())
+            total_loss += loss.item() * batch.batch_size
+            total_num += batch.batch_size
+      return torch.tensor(total_loss / total_num)
+
+
+@torch.no_grad()
+def test_mini_batch(model, loader):
+      model.eval()
+      correct, total_num = 0, 0
+      for batch in loader:
+            batch = batch.to(device, non_blocking=True)
+            with mixed_precision(amp, device_type=device.type):
+                  if prompt_type != 'gppt':
+                        out = model(batch.x, batch.edge_index, batch=None, prompt = prompt)
+                  else:
+                        out = model(batch.x, batch.edge_index)
+            pred = out[:batch.batch_size].argmax(dim=1)
+            correct += int((pred == batch.y[:batch.batch_size]).sum())
+            total_num += batch.batch_size
+      return correct / total_num
+
+
 def test(model, data, mask):
       model.eval()
-      if prompt_type != 'gppt':
-            out = model(data.x, data.edge_index, batch=None, prompt = prompt)
-      else:
-            out = model(data.x, data.edge_index)
+      with mixed_precision(amp, device_type=device.type):
+            if prompt_type != 'gppt':
+                  out = model(data.x, data.edge_index, batch=None, prompt = prompt, adj = adj)
+            else:
+                  out = model(data.x, data.edge_index)
       pred = out.argmax(dim=1)  
       correct = pred[mask] == data.y[mask]  
       acc = int(correct.sum()) / int(mask.sum())  
@@ -64,8 +138,14 @@ def test(model, data, mask):
 
 
 for epoch in range(1, 180):
-    data = data.to(device)
-    loss = train(model,data)
-    val_acc = test(model,data,data.val_mask)
-    test_acc = test(model,data,data.test_mask)
-    print("Epoch {:03d} | Loss {:.4f} | val Accuracy {:.4f} | test Accuracy {:.4f} ".format(epoch, loss.item(), val_acc, test_acc))
\ No newline at end of file
+    if mini_batch:
+        loss = train_mini_batch(model, train_loader)
+        val_acc = test_mini_batch(model, val_loader)
+        test_acc = test_mini_batch(model, test_loader)
+    else:
+        data = data.to(device)
+        loss = train(model,data)
+        val_acc = test(model,data,data.val_mask)
+        test_acc = test(model,data,data.test_mask)
+    if is_main_process():
+        print("Epoch {:03d} | Loss {:.4f} | val Accuracy {:.4f} | test Accuracy {:.4f} ".format(epoch, loss.item(), val_acc, test_acc))
\ No newline at end of file